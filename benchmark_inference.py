@@ -0,0 +1,88 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Compares exported models with the fp32 model. Reports tokens per second and how many of the
+# greedily generated tokens agree with the fp32 model. Uses the validation sequences for priming.
+#
+# python benchmark_inference.py --model_path training/jsb_mmmtrack/best_model --tokenizer_path datasets/jsb_mmmtrack/tokenizer.json --data_path datasets/jsb_mmmtrack/token_sequences_valid.txt --export_paths training/jsb_mmmtrack/best_model_int8 training/jsb_mmmtrack/best_model_torchscript
+
+import argparse
+import torch
+from transformers import PreTrainedTokenizerFast
+from source.helpers.exporthelpers import load_model
+from source.helpers.samplinghelpers import generate_batch
+
+parser = argparse.ArgumentParser(description="Benchmark exported MMM models against fp32.")
+parser.add_argument("--model_path", required=True)
+parser.add_argument("--tokenizer_path", required=True)
+parser.add_argument("--data_path", required=True)
+parser.add_argument("--export_paths", nargs="+", required=True)
+parser.add_argument("--sequences", type=int, default=32)
+parser.add_argument("--priming_tokens", type=int, default=64)
+parser.add_argument("--max_new_tokens", type=int, default=128)
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--threads", type=int, default=None)
+args = parser.parse_args()
+
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+tokenizer = PreTrainedTokenizerFast(tokenizer_file=args.tokenizer_path)
+tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+
+# The first sequences of the validation set, cut after the priming tokens.
+token_sequences = []
+with open(args.data_path, "r") as file:
+    for line in file:
+        tokens = line.split()
+        if len(tokens) != 0:
+            token_sequences += [" ".join(tokens[:args.priming_tokens])]
+        if len(token_sequences) == args.sequences:
+            break
+
+
+def run(model):
+
+    # Greedy, so that the models can be compared token by token. Stop tokens do not stop.
+    return generate_batch(
+        model,
+        tokenizer,
+        token_sequences,
+        max_new_tokens=args.max_new_tokens,
+        do_sample=False,
+        stop_tokens=[],
+        batch_size=args.batch_size,
+        return_statistics=True
+    )
+
+
+# The reference.
+reference_sequences, reference_statistics = run(load_model(args.model_path))
+print(f"{'model':<60} {'tokens/s':>10} {'speedup':>8} {'agreement':>10}")
+print(f"{args.model_path:<60} {reference_statistics['tokens_per_second']:>10.1f} {1.0:>8.2f} {1.0:>10.3f}")
+
+# The exported models. Agreement counts the generated tokens that are the same at the same position.
+for export_path in args.export_paths:
+    sequences, statistics = run(load_model(export_path))
+    agreeing_tokens, tokens = 0, 0
+    for token_sequence, reference_sequence, priming_sequence in zip(sequences, reference_sequences, token_sequences):
+        priming_length = len(priming_sequence.split())
+        generated = token_sequence[0].split()[priming_length:]
+        reference = reference_sequence[0].split()[priming_length:]
+        agreeing_tokens += sum(token == reference_token for token, reference_token in zip(generated, reference))
+        tokens += max(len(generated), len(reference))
+    speedup = statistics["tokens_per_second"] / reference_statistics["tokens_per_second"]
+    print(f"{export_path:<60} {statistics['tokens_per_second']:>10.1f} {speedup:>8.2f} {agreeing_tokens / max(tokens, 1):>10.3f}")
@@ -0,0 +1,55 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+import sys
+import time
+from music21 import corpus
+from source.preprocess.music21jsb import get_music21_part_measures
+
+
+def get_music21_part_measures_probing(part):
+    measures = []
+    for measure_index in range(1000):
+        measure = part.measure(measure_index)
+        if measure is None:
+            break
+        measures += [measure]
+    return measures
+
+
+# Parse the chorales up front. Only the measure extraction is timed.
+songs_number = int(sys.argv[1]) if len(sys.argv) > 1 else 371
+print(f"Parsing {songs_number} chorales...")
+parts = []
+for song in corpus.chorales.Iterator(1, songs_number):
+    parts += list(song.parts)
+print(f"Got {len(parts)} parts.")
+
+# Time both methods and make sure that they agree.
+durations = {}
+results = {}
+for name, method in [("probing", get_music21_part_measures_probing), ("single pass", get_music21_part_measures)]:
+    start_time = time.perf_counter()
+    results[name] = [method(part) for part in parts]
+    durations[name] = time.perf_counter() - start_time
+    print(f"{name:12s} {durations[name]:.3f}s")
+
+mismatches = 0
+for measures_probing, measures_single_pass in zip(results["probing"], results["single pass"]):
+    if [id(measure) for measure in measures_probing] != [id(measure) for measure in measures_single_pass]:
+        mismatches += 1
+print(f"Mismatching parts: {mismatches}/{len(parts)}")
+print(f"Speedup: {durations['probing'] / durations['single pass']:.1f}x")
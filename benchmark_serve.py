@@ -0,0 +1,73 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Load test for the sampling server. Start the server with python -m source.serve first.
+#
+# python benchmark_serve.py --data_path datasets/jsb_mmmtrack/token_sequences_valid.txt
+
+import argparse
+import json
+import time
+import urllib.request
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from source.helpers.samplinghelpers import get_priming_token_sequence
+
+parser = argparse.ArgumentParser(description="Load test for the MMM sampling server.")
+parser.add_argument("--url", default="http://127.0.0.1:8000/generate")
+parser.add_argument("--data_path", required=True)
+parser.add_argument("--requests", type=int, default=200)
+parser.add_argument("--concurrency", type=int, default=16)
+parser.add_argument("--max_new_tokens", type=int, default=64)
+parser.add_argument("--priming_tokens", type=int, default=20)
+args = parser.parse_args()
+
+
+def send_request(token_sequence):
+    body = json.dumps({
+        "token_sequences": [token_sequence],
+        "max_new_tokens": args.max_new_tokens
+    }).encode("utf-8")
+    request = urllib.request.Request(args.url, data=body, headers={"Content-Type": "application/json"})
+    start_time = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        result = json.loads(response.read())
+    latency = time.perf_counter() - start_time
+    generated_tokens = sum(len(sequence.split()) for sequences in result["token_sequences"] for sequence in sequences) - len(token_sequence.split())
+    return latency, generated_tokens
+
+
+# Prepare the priming sequences.
+token_sequences = [
+    get_priming_token_sequence(args.data_path, stop_after_n_tokens=args.priming_tokens)
+    for _ in range(args.requests)
+]
+
+# Fire the requests.
+print(f"Sending {args.requests} requests with concurrency {args.concurrency}...")
+start_time = time.perf_counter()
+with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    results = list(executor.map(send_request, token_sequences))
+duration = time.perf_counter() - start_time
+
+# Report.
+latencies = np.array([latency for latency, _ in results])
+generated_tokens = sum(tokens for _, tokens in results)
+print(f"Requests per second: {args.requests / duration:.2f}")
+print(f"Tokens per second:   {generated_tokens / duration:.1f}")
+print(f"Latency p50:         {1000 * np.percentile(latencies, 50):.1f}ms")
+print(f"Latency p99:         {1000 * np.percentile(latencies, 99):.1f}ms")
+print(f"Latency max:         {1000 * np.max(latencies):.1f}ms")
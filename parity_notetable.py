@@ -0,0 +1,99 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Checks token_sequences_to_note_sequences against token_sequence_to_note_sequence.
+# 1. Valid token sequences give the same notes.
+# 2. Malformed token sequences fail in both or give the same notes in both.
+#
+# python parity_notetable.py --data_path datasets/jsb_mmmtrack/token_sequences_valid.txt
+
+import argparse
+import random
+import sys
+from source.helpers.samplinghelpers import token_sequence_to_note_sequence, token_sequences_to_note_sequences
+
+parser = argparse.ArgumentParser(description="Parity of the note table and the note sequence decoders.")
+parser.add_argument("--data_path", required=True)
+parser.add_argument("--sequences", type=int, default=500)
+parser.add_argument("--malformed_sequences", type=int, default=5000)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+random.seed(args.seed)
+
+# Tokens that break the structure. Plus the ones of the data.
+MALFORMED_TOKENS = [
+    "PIECE_START", "PIECE_END", "TRACK_START", "TRACK_END", "BAR_START", "BAR_END", "INST=0", "INST=DRUMS",
+    "INST=X", "NOTE_ON=60", "NOTE_OFF=60", "NOTE_ON=X", "TIME_DELTA=4", "TIME_DELTA=X", "DENSITY=1", "[PAD]", "UNKNOWN"
+]
+
+
+def get_notes(note_sequence):
+    return [(note.pitch, note.start_time, note.end_time, note.instrument, note.program, note.velocity, note.is_drum) for note in note_sequence.notes]
+
+
+def decode_reference(token_sequence, use_program, use_drums):
+    try:
+        return get_notes(token_sequence_to_note_sequence(token_sequence, use_program=use_program, use_drums=use_drums))
+    except Exception:
+        return None
+
+
+def malform(tokens):
+
+    # Short random sequences and sequences with tokens inserted, deleted or swapped.
+    if len(tokens) == 0 or random.random() < 0.3:
+        return [random.choice(MALFORMED_TOKENS) for _ in range(random.randint(0, 12))]
+    tokens = list(tokens)
+    for _ in range(random.randint(1, 3)):
+        operation = random.choice(["insert", "delete", "swap"])
+        index = random.randrange(len(tokens) + 1)
+        if operation == "insert":
+            tokens.insert(index, random.choice(MALFORMED_TOKENS + tokens))
+        elif operation == "delete" and index < len(tokens):
+            del tokens[index]
+        elif operation == "swap" and len(tokens) > 1:
+            other_index = random.randrange(len(tokens))
+            index = min(index, len(tokens) - 1)
+            tokens[index], tokens[other_index] = tokens[other_index], tokens[index]
+    return tokens
+
+
+with open(args.data_path, "r") as file:
+    token_sequences = [line.split() for line in file if line.strip() != ""][:args.sequences]
+malformed_token_sequences = [malform(random.choice(token_sequences)[:40]) for _ in range(args.malformed_sequences)]
+malformed_token_sequences += [
+    "PIECE_START BAR_END TRACK_START INST=0 BAR_START NOTE_ON=60 TIME_DELTA=4 NOTE_OFF=60 BAR_END TRACK_END".split(),
+    "PIECE_START TIME_DELTA=4 TRACK_START INST=0 BAR_START NOTE_ON=60 TIME_DELTA=4 NOTE_OFF=60 BAR_END TRACK_END".split(),
+    "PIECE_START TRACK_END TRACK_START INST=0 BAR_START NOTE_ON=60 TIME_DELTA=4 NOTE_OFF=60 BAR_END TRACK_END".split()
+]
+
+failures = 0
+for name, sequences in [("valid", token_sequences), ("malformed", malformed_token_sequences)]:
+    for use_program in [True, False]:
+        for use_drums in [True, False]:
+            note_sequences = token_sequences_to_note_sequences(sequences, use_program=use_program, use_drums=use_drums, skip_invalid=True)
+            mismatches = 0
+            for token_sequence, note_sequence in zip(sequences, note_sequences):
+                notes = get_notes(note_sequence) if note_sequence is not None else None
+                if notes != decode_reference(token_sequence, use_program, use_drums):
+                    mismatches += 1
+                    if mismatches <= 3:
+                        print(f"Mismatch: {' '.join(token_sequence)}")
+            print(f"{name} use_program={use_program} use_drums={use_drums}: {len(sequences) - mismatches} of {len(sequences)} the same.")
+            failures += mismatches
+
+sys.exit(1 if failures != 0 else 0)
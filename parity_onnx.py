@@ -0,0 +1,112 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Checks the ONNX model and the NumPy sampling loop against the PyTorch path.
+# 1. The greedy continuations are the same.
+# 2. The sampling distributions after temperature, top-k and top-p are the same.
+# 3. Sampling with a fixed seed is reproducible.
+#
+# python parity_onnx.py --model_path training/jsb_mmmtrack/best_model --onnx_model_path training/jsb_mmmtrack/best_model_onnx --tokenizer_path datasets/jsb_mmmtrack/tokenizer.json --data_path datasets/jsb_mmmtrack/token_sequences_valid.txt
+
+import argparse
+import sys
+import numpy as np
+import torch
+from transformers import GPT2LMHeadModel, PreTrainedTokenizerFast
+from transformers import LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from source.helpers.onnxsamplinghelpers import generate_batch_onnx, load_onnx_model, process_logits, softmax
+from source.helpers.samplinghelpers import generate_batch
+
+parser = argparse.ArgumentParser(description="Parity of the ONNX and the PyTorch sampling.")
+parser.add_argument("--model_path", required=True)
+parser.add_argument("--onnx_model_path", required=True)
+parser.add_argument("--tokenizer_path", required=True)
+parser.add_argument("--data_path", required=True)
+parser.add_argument("--sequences", type=int, default=8)
+parser.add_argument("--priming_tokens", type=int, default=32)
+parser.add_argument("--max_new_tokens", type=int, default=64)
+parser.add_argument("--temperature", type=float, default=0.9)
+parser.add_argument("--top_k", type=int, default=20)
+parser.add_argument("--top_p", type=float, default=0.9)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--tolerance", type=float, default=1e-4)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+# Both paths.
+tokenizer = PreTrainedTokenizerFast(tokenizer_file=args.tokenizer_path)
+tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+model = GPT2LMHeadModel.from_pretrained(args.model_path)
+model.eval()
+onnx_model, onnx_tokenizer = load_onnx_model(args.onnx_model_path, args.tokenizer_path)
+
+# Priming sequences of different lengths, so that there is padding.
+token_sequences = []
+with open(args.data_path, "r") as file:
+    for line in file:
+        tokens = line.split()
+        if len(tokens) != 0:
+            token_sequences += [" ".join(tokens[:args.priming_tokens - len(token_sequences) % 4])]
+        if len(token_sequences) == args.sequences:
+            break
+failures = []
+
+# 1. Greedy.
+generate_kwargs = {"max_new_tokens": args.max_new_tokens, "do_sample": False, "stop_tokens_count": 2}
+sequences = generate_batch(model, tokenizer, token_sequences, **generate_kwargs)
+onnx_sequences = generate_batch_onnx(onnx_model, onnx_tokenizer, token_sequences, **generate_kwargs)
+same_sequences = sum(sequence == onnx_sequence for sequence, onnx_sequence in zip(sequences, onnx_sequences))
+print(f"Greedy: {same_sequences}/{len(token_sequences)} sequences are the same.")
+if same_sequences != len(token_sequences):
+    failures += ["greedy"]
+
+# 2. The distributions along the greedy continuations.
+warpers = LogitsProcessorList([
+    TemperatureLogitsWarper(args.temperature),
+    TopKLogitsWarper(top_k=args.top_k),
+    TopPLogitsWarper(top_p=args.top_p)
+])
+maximum_difference = 0.0
+for sequence in sequences:
+    input_ids = tokenizer(sequence[0], return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        logits = model(input_ids).logits[0]
+    probabilities = torch.softmax(warpers(input_ids, logits), dim=-1).numpy()
+
+    # The ONNX model runs the whole sequence as a prompt.
+    attention_mask = np.ones_like(input_ids.numpy())
+    onnx_probabilities = []
+    for length in range(1, input_ids.shape[1] + 1):
+        onnx_logits, _ = onnx_model.forward(input_ids.numpy()[:, :length], attention_mask[:, :length], np.arange(length)[None], onnx_model.get_empty_past(1))
+        onnx_probabilities += [softmax(process_logits(onnx_logits, args.temperature, args.top_k, args.top_p))[0]]
+    maximum_difference = max(maximum_difference, float(np.max(np.abs(probabilities - np.array(onnx_probabilities)))))
+print(f"Sampling distributions: maximum difference {maximum_difference:.2e}.")
+if maximum_difference > args.tolerance:
+    failures += ["distributions"]
+
+# 3. Fixed seed.
+generate_kwargs = {"max_new_tokens": args.max_new_tokens, "temperature": args.temperature, "top_k": args.top_k, "top_p": args.top_p, "seed": args.seed}
+first_sequences = generate_batch_onnx(onnx_model, onnx_tokenizer, token_sequences, **generate_kwargs)
+second_sequences = generate_batch_onnx(onnx_model, onnx_tokenizer, token_sequences, **generate_kwargs)
+print(f"Fixed seed: {'reproducible' if first_sequences == second_sequences else 'not reproducible'}.")
+if first_sequences != second_sequences:
+    failures += ["seed"]
+
+if len(failures) != 0:
+    print(f"Failed: {', '.join(failures)}.")
+    sys.exit(1)
+print("Passed.")
@@ -15,16 +15,36 @@
 # Lint as: python3
 
 import os
+import functools
 from tokenizers import Tokenizer
 from tokenizers.models import WordLevel
 from tokenizers.pre_tokenizers import WhitespaceSplit
 from tokenizers.trainers import WordLevelTrainer
 from source import logging
 from source.preprocess.music21jsb import preprocess_music21
-from source.preprocess.encode import encode_songs_data, get_density_bins
+from source.preprocess.encode import (
+    encode_song_data,
+    encode_songs_data_stream,
+    get_density_bins,
+    get_song_vocabulary,
+    get_vocabulary
+)
+from source.preprocess.preprocessutilities import get_song_data_hash, song_data_to_compact
+from source.helpers.tokenidshelpers import save_token_ids_from_token_sequences
+from source.helpers.metadatahelpers import MetadataWriter, get_metadata_path, get_metadata_row, load_metadata
+from source.helpers.manifesthelpers import (
+    MANIFEST_FILE,
+    get_manifest_config,
+    get_manifest_vocabulary,
+    load_manifest,
+    save_manifest
+)
 
 logger = logging.create_logger("datasetcreator")
 
+TOKEN_SEQUENCES_BUFFER_SIZE = 1024 * 1024
+SPECIAL_TOKENS = ["[UNK]", "[CLS]", "[SEP]", "[PAD]", "[MASK]"]
+
 
 class DatasetCreator:
 
@@ -32,7 +52,7 @@ class DatasetCreator:
 
         self.config = config
 
-    def create(self, datasets_path, overwrite=False):
+    def create(self, datasets_path, overwrite=False, incremental=False):
 
         # Make sure that datasets path exists.
         if not os.path.exists(datasets_path):
@@ -40,7 +60,7 @@ class DatasetCreator:
 
         # Make sure that path for this specific dataset exists.
         dataset_path = os.path.join(datasets_path, self.config.dataset_name)
-        if os.path.exists(dataset_path) and overwrite is False:
+        if os.path.exists(dataset_path) and overwrite is False and incremental is False:
             logger.info("Dataset already exists.")
             return
         if not os.path.exists(dataset_path):
@@ -49,7 +69,12 @@ class DatasetCreator:
         # Prepare for getting music data as JSON.
         json_data_method = None
         if self.config.json_data_method == "preprocess_music21":
-            json_data_method = preprocess_music21
+            json_data_method = functools.partial(
+                preprocess_music21,
+                workers=self.config.preprocess_workers,
+                chunk_size=self.config.preprocess_chunk_size,
+                cache_path=self.config.json_cache_path
+            )
         elif callable(self.config.json_data_method):
             json_data_method = self.config.json_data_method
         else:
@@ -57,55 +82,269 @@ class DatasetCreator:
             logger.error(error_string)
             raise Exception(error_string)
 
-        # Get music data as JSON.
+        # Get music data as JSON. Then use the compact event representation for encoding.
         songs_data_train, songs_data_valid = json_data_method()
+        if incremental:
+            self.__create_incremental(dataset_path, songs_data_train, songs_data_valid)
+            return
+        songs_data_train = [song_data_to_compact(song_data) for song_data in songs_data_train]
+        songs_data_valid = [song_data_to_compact(song_data) for song_data in songs_data_valid]
 
         # Get density bins.
         density_bins = get_density_bins(
             songs_data_train,
             self.config.window_size_bars,
             self.config.hop_length_bars,
-            self.config.density_bins_number
+            self.config.density_bins_number,
+            streaming=self.config.density_bins_streaming
         )
 
-        # Process and save training data.
-        token_sequences_train = encode_songs_data(
+        # The analytical vocabulary comes from the songs. Get it before encoding, because bar fill
+        # changes the songs.
+        if self.config.vocabulary_method == "analytical":
+            songs_vocabulary = set()
+            for songs_data, transpositions in [(songs_data_train, self.config.transpositions_train), (songs_data_valid, [0])]:
+                for song_data in songs_data:
+                    songs_vocabulary |= get_song_vocabulary(song_data, transpositions, self.config.window_size_bars, self.config.hop_length_bars)
+            vocabulary = get_vocabulary(songs_vocabulary, density_bins, self.config.encoding_method == "mmmbar")
+
+        # Process and save training data. The sequences are written as they are encoded.
+        token_sequences_train = encode_songs_data_stream(
             songs_data_train,
             transpositions=self.config.transpositions_train,
             permute=self.config.permute_tracks,
             window_size_bars=self.config.window_size_bars,
             hop_length_bars=self.config.hop_length_bars,
             density_bins=density_bins,
-            bar_fill=self.config.encoding_method == "mmmbar"
+            bar_fill=self.config.encoding_method == "mmmbar",
+            return_metadata=self.config.metadata_output
         )
         dataset_path_train = os.path.join(dataset_path, "token_sequences_train.txt")
         self.__save_token_sequences(token_sequences_train, dataset_path_train)
         logger.info(f"Saved training data to {dataset_path_train}.")
 
-        # Process and save validation data.
-        token_sequences_valid = encode_songs_data(
+        # Process and save validation data. The sequences are written as they are encoded.
+        token_sequences_valid = encode_songs_data_stream(
             songs_data_valid,
             transpositions=[0],
             permute=self.config.permute_tracks,
             window_size_bars=self.config.window_size_bars,
             hop_length_bars=self.config.hop_length_bars,
             density_bins=density_bins,
-            bar_fill=self.config.encoding_method == "mmmbar"
+            bar_fill=self.config.encoding_method == "mmmbar",
+            return_metadata=self.config.metadata_output
         )
         dataset_path_valid = os.path.join(dataset_path, "token_sequences_valid.txt")
         self.__save_token_sequences(token_sequences_valid, dataset_path_valid)
         logger.info(f"Saved validation data to {dataset_path_valid}.")
 
         # Create and save tokenizer.
-        tokenizer = self.__create_tokenizer([dataset_path_train, dataset_path_valid])
+        if self.config.vocabulary_method == "analytical":
+            tokenizer = self.__create_tokenizer_from_vocabulary(vocabulary)
+        else:
+            tokenizer = self.__create_tokenizer([dataset_path_train, dataset_path_valid])
         tokenizer_path = os.path.join(dataset_path, "tokenizer.json")
         tokenizer.save(tokenizer_path)
         logger.info(f"Saved tokenizer to {tokenizer_path}.")
 
+        # Save the token ids as binary files. This way training does not have to tokenize.
+        if self.config.token_ids_output:
+            for dataset_path_text, split in [(dataset_path_train, "train"), (dataset_path_valid, "valid")]:
+                dataset_path_token_ids = os.path.join(dataset_path, f"token_ids_{split}.bin")
+                save_token_ids_from_token_sequences(tokenizer, dataset_path_text, dataset_path_token_ids)
+                logger.info(f"Saved token ids to {dataset_path_token_ids}.")
+
+    def __create_incremental(self, dataset_path, songs_data_train, songs_data_valid):
+
+        # Load the manifest of the last build. Without one, or if the encoding config has
+        # changed since, all songs are encoded.
+        manifest_path = os.path.join(dataset_path, MANIFEST_FILE)
+        manifest = load_manifest(manifest_path)
+        manifest_config = get_manifest_config(self.config)
+        if manifest is not None and manifest["config"] != manifest_config:
+            logger.info("The encoding config has changed. Encoding all songs.")
+            manifest = None
+
+        # The density bins are kept from the first build. Otherwise every new song would change
+        # them and with them the DENSITY tokens of all songs.
+        if manifest is not None:
+            density_bins = manifest["density_bins"]
+        else:
+            density_bins = get_density_bins(
+                [song_data_to_compact(song_data) for song_data in songs_data_train],
+                self.config.window_size_bars,
+                self.config.hop_length_bars,
+                self.config.density_bins_number,
+                streaming=self.config.density_bins_streaming
+            )
+            density_bins = [float(density_bin) for density_bin in density_bins]
+
+        # Update the token sequences files. Only songs that are new or have changed are encoded.
+        splits = {}
+        changed_paths = []
+        for split, songs_data, transpositions in [("train", songs_data_train, self.config.transpositions_train), ("valid", songs_data_valid, [0])]:
+            path = os.path.join(dataset_path, f"token_sequences_{split}.txt")
+            previous_songs = manifest["splits"][split] if manifest is not None and os.path.exists(path) else []
+            songs_hashes = [get_song_data_hash(song_data) for song_data in songs_data]
+            if songs_hashes == [song["hash"] for song in previous_songs]:
+                logger.info(f"No changes in {path}.")
+                splits[split] = previous_songs
+                continue
+            splits[split] = self.__save_songs_incremental(songs_data, songs_hashes, transpositions, density_bins, path, previous_songs)
+            changed_paths += [path]
+        manifest = {"config": manifest_config, "density_bins": density_bins, "splits": splits}
+
+        # Create the tokenizer only if the vocabulary has changed. This keeps the token ids.
+        dataset_path_train = os.path.join(dataset_path, "token_sequences_train.txt")
+        dataset_path_valid = os.path.join(dataset_path, "token_sequences_valid.txt")
+        tokenizer_path = os.path.join(dataset_path, "tokenizer.json")
+        tokenizer = Tokenizer.from_file(tokenizer_path) if os.path.exists(tokenizer_path) else None
+        if self.config.vocabulary_method == "analytical":
+            vocabulary = get_vocabulary(get_manifest_vocabulary(manifest), density_bins, self.config.encoding_method == "mmmbar")
+            is_vocabulary_changed = tokenizer is None or tokenizer.get_vocab() != get_vocabulary_ids(vocabulary)
+        else:
+            is_vocabulary_changed = tokenizer is None or set(tokenizer.get_vocab().keys()) - set(SPECIAL_TOKENS) != get_manifest_vocabulary(manifest)
+        if is_vocabulary_changed:
+            if self.config.vocabulary_method == "analytical":
+                tokenizer = self.__create_tokenizer_from_vocabulary(vocabulary)
+            else:
+                tokenizer = self.__create_tokenizer([dataset_path_train, dataset_path_valid])
+            tokenizer.save(tokenizer_path)
+            logger.info(f"Saved tokenizer to {tokenizer_path}.")
+            changed_paths = [dataset_path_train, dataset_path_valid]
+        else:
+            logger.info("The vocabulary has not changed. Keeping the tokenizer.")
+
+        # Save the token ids of the token sequences files that have changed.
+        if self.config.token_ids_output:
+            for dataset_path_text, split in [(dataset_path_train, "train"), (dataset_path_valid, "valid")]:
+                dataset_path_token_ids = os.path.join(dataset_path, f"token_ids_{split}.bin")
+                if dataset_path_text in changed_paths or not os.path.exists(dataset_path_token_ids):
+                    save_token_ids_from_token_sequences(tokenizer, dataset_path_text, dataset_path_token_ids)
+                    logger.info(f"Saved token ids to {dataset_path_token_ids}.")
+
+        # The manifest comes last. If the build is interrupted, the next one starts from the last manifest.
+        save_manifest(manifest_path, manifest)
+        logger.info(f"Saved manifest to {manifest_path}.")
+
+    def __save_songs_incremental(self, songs_data, songs_hashes, transpositions, density_bins, path, previous_songs):
+
+        # If the previous songs are unchanged and come first, the new songs are appended.
+        # Otherwise the file is written again. Unchanged songs are copied from the old file.
+        previous_songs_by_hash = {song["hash"]: song for song in previous_songs}
+        is_append = len(previous_songs) != 0 and songs_hashes[:len(previous_songs)] == [song["hash"] for song in previous_songs]
+        previous_metadata = None
+        if self.config.metadata_output and len(previous_songs) != 0:
+            previous_metadata = load_metadata(get_metadata_path(path))
+        metadata_writer = MetadataWriter() if self.config.metadata_output else None
+
+        songs = []
+        songs_index = 0
+        offset = 0
+        line_index = 0
+        encoded_number = 0
+        previous_file = open(path, "rb") if len(previous_songs) != 0 else None
+        if is_append:
+            file = open(path, "r+b", buffering=TOKEN_SEQUENCES_BUFFER_SIZE)
+            for song in previous_songs:
+                self.__copy_song_metadata(previous_metadata, song, offset, metadata_writer)
+                songs += [song]
+                offset += song["length"]
+                line_index += song["lines"]
+            songs_index = len(previous_songs)
+            file.seek(offset)
+            file.truncate()
+        else:
+            file = open(path + ".tmp", "wb", buffering=TOKEN_SEQUENCES_BUFFER_SIZE)
+
+        with file:
+            for song_data, song_hash in zip(songs_data[songs_index:], songs_hashes[songs_index:]):
+
+                # Copy an unchanged song.
+                previous_song = previous_songs_by_hash.get(song_hash, None)
+                if previous_song is not None:
+                    previous_file.seek(previous_song["offset"])
+                    file.write(previous_file.read(previous_song["length"]))
+                    self.__copy_song_metadata(previous_metadata, previous_song, offset, metadata_writer)
+                    song = dict(previous_song, offset=offset, line=line_index)
+
+                # Encode a new or changed song.
+                else:
+                    song = self.__save_song(file, song_data, song_hash, transpositions, density_bins, offset, line_index, metadata_writer)
+                    encoded_number += 1
+                songs += [song]
+                offset += song["length"]
+                line_index += song["lines"]
+
+        if previous_file is not None:
+            previous_file.close()
+        if not is_append:
+            os.replace(path + ".tmp", path)
+        if metadata_writer is not None:
+            metadata_writer.save(get_metadata_path(path))
+        logger.info(f"Saved {path}. Encoded {encoded_number} of {len(songs)} songs.")
+        return songs
+
+    def __save_song(self, file, song_data, song_hash, transpositions, density_bins, offset, line_index, metadata_writer):
+
+        # Encode and write one song. Returns its entry for the manifest.
+        song = {"hash": song_hash, "offset": offset, "line": line_index}
+        vocabulary = set()
+        lines_number = 0
+        for token_sequence in encode_song_data(
+            song_data_to_compact(song_data),
+            transpositions=transpositions,
+            permute=self.config.permute_tracks,
+            window_size_bars=self.config.window_size_bars,
+            hop_length_bars=self.config.hop_length_bars,
+            density_bins=density_bins,
+            bar_fill=self.config.encoding_method == "mmmbar",
+            return_metadata=metadata_writer is not None
+        ):
+            if metadata_writer is not None:
+                token_sequence, metadata = token_sequence
+            line = (" ".join(token_sequence) + "\n").encode("utf-8")
+            file.write(line)
+            if metadata_writer is not None:
+                metadata_writer.add(metadata, offset, len(line))
+            offset += len(line)
+            vocabulary.update(token_sequence)
+            lines_number += 1
+        song["length"] = offset - song["offset"]
+        song["lines"] = lines_number
+        song["vocabulary"] = sorted(vocabulary)
+        return song
+
+    def __copy_song_metadata(self, previous_metadata, song, offset, metadata_writer):
+
+        # The metadata of the lines of a copied song. Only the offsets change.
+        if metadata_writer is None:
+            return
+        offsets = previous_metadata["offsets"]
+        lengths = previous_metadata["lengths"]
+        for previous_line_index in range(song["line"], song["line"] + song["lines"]):
+            line_offset = offset + int(offsets[previous_line_index]) - song["offset"]
+            metadata_writer.add(get_metadata_row(previous_metadata, previous_line_index), line_offset, int(lengths[previous_line_index]))
+
     def __save_token_sequences(self, token_sequences, path):
-        with open(path, "w") as file:
-            for token_sequence in token_sequences:
-                print(" ".join(token_sequence), file=file)
+        if not self.config.metadata_output:
+            with open(path, "w", buffering=TOKEN_SEQUENCES_BUFFER_SIZE) as file:
+                for token_sequence in token_sequences:
+                    file.write(" ".join(token_sequence) + "\n")
+            return
+
+        # The token sequences come with their metadata. Keep track of the byte offsets of the lines.
+        metadata_writer = MetadataWriter()
+        with open(path, "wb", buffering=TOKEN_SEQUENCES_BUFFER_SIZE) as file:
+            offset = 0
+            for token_sequence, metadata in token_sequences:
+                line = (" ".join(token_sequence) + "\n").encode("utf-8")
+                file.write(line)
+                metadata_writer.add(metadata, offset, len(line))
+                offset += len(line)
+        metadata_path = get_metadata_path(path)
+        metadata_writer.save(metadata_path)
+        logger.info(f"Saved metadata to {metadata_path}.")
 
     def __create_tokenizer(self, files):
 
@@ -114,7 +353,20 @@ class DatasetCreator:
         tokenizer = Tokenizer(WordLevel(unk_token="[UNK]"))
         tokenizer.pre_tokenizer = WhitespaceSplit()
         trainer = WordLevelTrainer(
-            special_tokens=["[UNK]", "[CLS]", "[SEP]", "[PAD]", "[MASK]"]
+            special_tokens=SPECIAL_TOKENS
         )
         tokenizer.train(files=files, trainer=trainer)
         return tokenizer
+
+    def __create_tokenizer_from_vocabulary(self, vocabulary):
+
+        # The same tokenizer as __create_tokenizer, without training. The special tokens come
+        # first, then the vocabulary in the given order.
+        tokenizer = Tokenizer(WordLevel(vocab=get_vocabulary_ids(vocabulary), unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = WhitespaceSplit()
+        tokenizer.add_special_tokens(SPECIAL_TOKENS)
+        return tokenizer
+
+
+def get_vocabulary_ids(vocabulary):
+    return {token: token_id for token_id, token in enumerate(SPECIAL_TOKENS + list(vocabulary))}
@@ -30,7 +30,14 @@ class DatasetCreatorBaseConfig:
         hop_length_bars,
         density_bins_number,
         transpositions_train,
-        permute_tracks
+        permute_tracks,
+        preprocess_workers=1,
+        preprocess_chunk_size=1,
+        json_cache_path=None,
+        token_ids_output=False,
+        metadata_output=False,
+        vocabulary_method="train",
+        density_bins_streaming=False
         ):
 
         # Check if the datasetname is fine.
@@ -76,6 +83,41 @@ class DatasetCreatorBaseConfig:
             logger.error(error_string)
             raise Exception(error_string)
 
+        if not isinstance(preprocess_workers, int) or preprocess_workers < 1:
+            error_string = f"Config parameter preprocess_workers must be a positive integer, but is {preprocess_workers}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if not isinstance(preprocess_chunk_size, int) or preprocess_chunk_size < 1:
+            error_string = f"Config parameter preprocess_chunk_size must be a positive integer, but is {preprocess_chunk_size}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if json_cache_path is not None and not isinstance(json_cache_path, str):
+            error_string = f"Config parameter json_cache_path must be a string or None, but is {json_cache_path}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if not isinstance(token_ids_output, bool):
+            error_string = f"Config parameter token_ids_output must be a boolean, but is {token_ids_output}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if not isinstance(metadata_output, bool):
+            error_string = f"Config parameter metadata_output must be a boolean, but is {metadata_output}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if vocabulary_method not in ["train", "analytical"]:
+            error_string = f"Config parameter vocabulary_method must be train or analytical, but is {vocabulary_method}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if not isinstance(density_bins_streaming, bool):
+            error_string = f"Config parameter density_bins_streaming must be a boolean, but is {density_bins_streaming}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
 
         # Assign.
         self.dataset_name = dataset_name
@@ -86,6 +128,13 @@ class DatasetCreatorBaseConfig:
         self.density_bins_number = density_bins_number
         self.transpositions_train = transpositions_train
         self.permute_tracks = permute_tracks
+        self.preprocess_workers = preprocess_workers
+        self.preprocess_chunk_size = preprocess_chunk_size
+        self.json_cache_path = json_cache_path
+        self.token_ids_output = token_ids_output
+        self.metadata_output = metadata_output
+        self.vocabulary_method = vocabulary_method
+        self.density_bins_streaming = density_bins_streaming
 
 
 
@@ -0,0 +1,48 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Exports a best_model checkpoint for fast inference on the CPU.
+#
+# python -m source.export --model_path training/jsb_mmmtrack/best_model --output_path training/jsb_mmmtrack/best_model_int8 --quantize
+# python -m source.export --model_path training/jsb_mmmtrack/best_model --output_path training/jsb_mmmtrack/best_model_torchscript --torchscript
+# python -m source.export --model_path training/jsb_mmmtrack/best_model --output_path training/jsb_mmmtrack/best_model_onnx --onnx
+#
+# Load the result with source.helpers.exporthelpers.load_model. ONNX models are loaded with
+# source.helpers.onnxsamplinghelpers.load_onnx_model instead.
+
+import argparse
+from source.helpers.exporthelpers import export_model, export_onnx_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an MMM model for CPU inference.")
+    parser.add_argument("--model_path", required=True)
+    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--quantize", action="store_true", help="Dynamic int8 quantization of the linear layers.")
+    parser.add_argument("--torchscript", action="store_true", help="Trace the model with TorchScript.")
+    parser.add_argument("--onnx", action="store_true", help="Export to ONNX. Cannot be combined with the other options.")
+    args = parser.parse_args()
+
+    if args.onnx:
+        if args.quantize or args.torchscript:
+            parser.error("--onnx cannot be combined with --quantize or --torchscript.")
+        export_onnx_model(args.model_path, args.output_path)
+    else:
+        export_model(args.model_path, args.output_path, quantize=args.quantize, torchscript=args.torchscript)
+
+
+if __name__ == "__main__":
+    main()
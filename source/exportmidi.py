@@ -0,0 +1,48 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Writes a MIDI file for each token sequence in a text file. One token sequence per line.
+#
+# python -m source.exportmidi --input_path generated.txt --output_path midi --workers 8
+
+import argparse
+from source.helpers.midihelpers import export_midi_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export token sequences to MIDI files.")
+    parser.add_argument("--input_path", required=True)
+    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    parser.add_argument("--no_program", action="store_true", help="Do not set the programs of the instruments.")
+    parser.add_argument("--no_drums", action="store_true", help="Do not handle INST=DRUMS.")
+    args = parser.parse_args()
+
+    with open(args.input_path, "r") as file:
+        token_sequences = [line.strip() for line in file if line.strip() != ""]
+    export_midi_files(
+        token_sequences,
+        args.output_path,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        use_program=not args.no_program,
+        use_drums=not args.no_drums
+    )
+
+
+if __name__ == "__main__":
+    main()
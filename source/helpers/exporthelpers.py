@@ -0,0 +1,302 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+import copy
+import os
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, LogitsProcessorList, StoppingCriteriaList
+from transformers import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from transformers.cache_utils import DynamicCache
+from transformers.pytorch_utils import Conv1D
+from source import logging
+
+logger = logging.create_logger("exporthelpers")
+
+QUANTIZED_MODEL_FILE = "model_quantized.pt"
+TORCHSCRIPT_MODEL_FILE = "model_torchscript.pt"
+
+# The defaults of generate in transformers.
+GENERATE_MAX_LENGTH_DEFAULT = 20
+GENERATE_TOP_K_DEFAULT = 50
+
+
+def export_model(model_path, output_path, quantize=True, torchscript=False):
+
+    # Exports a best_model checkpoint for fast inference on the CPU. The output directory
+    # can be loaded with load_model.
+    if not quantize and not torchscript:
+        error_string = "Nothing to export. Set quantize and/or torchscript."
+        logger.error(error_string)
+        raise Exception(error_string)
+
+    model = GPT2LMHeadModel.from_pretrained(model_path)
+    model.eval()
+    if quantize:
+        model = quantize_model(model)
+
+    # The config is needed for loading.
+    os.makedirs(output_path, exist_ok=True)
+    model.config.save_pretrained(output_path)
+    if torchscript:
+        path = os.path.join(output_path, TORCHSCRIPT_MODEL_FILE)
+        torch.jit.save(trace_model(model), path)
+    else:
+        path = os.path.join(output_path, QUANTIZED_MODEL_FILE)
+        torch.save(model.state_dict(), path)
+    logger.info(f"Exported model to {path}.")
+    return path
+
+
+def export_onnx_model(model_path, output_path, opset_version=17):
+
+    # Exports a best_model checkpoint to ONNX. One graph with the key value cache as inputs
+    # and outputs. An empty cache runs the prompt. Sample with onnxsamplinghelpers.
+    from source.helpers.onnxsamplinghelpers import ONNX_MODEL_FILE
+    model = GPT2LMHeadModel.from_pretrained(model_path)
+    model.eval()
+    config = model.config
+    os.makedirs(output_path, exist_ok=True)
+    config.save_pretrained(output_path)
+
+    # Names and dynamic axes of the cache.
+    past_names, present_names = [], []
+    for layer_index in range(config.n_layer):
+        past_names += [f"past_key_values.{layer_index}.key", f"past_key_values.{layer_index}.value"]
+        present_names += [f"present.{layer_index}.key", f"present.{layer_index}.value"]
+    dynamic_axes = {
+        "input_ids": {0: "batch_size", 1: "sequence_length"},
+        "attention_mask": {0: "batch_size", 1: "total_sequence_length"},
+        "position_ids": {0: "batch_size", 1: "sequence_length"},
+        "logits": {0: "batch_size"}
+    }
+    for name in past_names:
+        dynamic_axes[name] = {0: "batch_size", 2: "past_sequence_length"}
+    for name in present_names:
+        dynamic_axes[name] = {0: "batch_size", 2: "total_sequence_length"}
+
+    # Example inputs. Left padded and with a cache, so that the graph covers everything.
+    batch_size, sequence_length, past_length = 2, 3, 4
+    attention_mask = torch.ones((batch_size, past_length + sequence_length), dtype=torch.long)
+    attention_mask[0, :2] = 0
+    head_size = config.n_embd // config.n_head
+    inputs = (
+        torch.zeros((batch_size, sequence_length), dtype=torch.long),
+        attention_mask,
+        get_position_ids(attention_mask)[:, -sequence_length:],
+        tuple(torch.zeros((batch_size, config.n_head, past_length, head_size)) for _ in range(2 * config.n_layer))
+    )
+
+    path = os.path.join(output_path, ONNX_MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            GPT2OnnxWrapper(model),
+            inputs,
+            path,
+            input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+            output_names=["logits"] + present_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            dynamo=False
+        )
+    logger.info(f"Exported model to {path}.")
+    return path
+
+
+def load_model(model_path):
+
+    # Loads a best_model checkpoint or anything that export_model has written. All of them
+    # can be passed to the functions in samplinghelpers.
+    torchscript_path = os.path.join(model_path, TORCHSCRIPT_MODEL_FILE)
+    quantized_path = os.path.join(model_path, QUANTIZED_MODEL_FILE)
+    if os.path.exists(torchscript_path):
+        config = GPT2Config.from_pretrained(model_path)
+        model = TorchScriptGPT2Model(torch.jit.load(torchscript_path), config)
+    elif os.path.exists(quantized_path):
+        config = GPT2Config.from_pretrained(model_path)
+        model = quantize_model(GPT2LMHeadModel(config))
+        model.load_state_dict(torch.load(quantized_path, weights_only=False))
+    else:
+        model = GPT2LMHeadModel.from_pretrained(model_path)
+    model.eval()
+    return model
+
+
+def quantize_model(model):
+
+    # GPT-2 uses Conv1D layers. These are linear layers with a transposed weight, but
+    # dynamic quantization only knows torch.nn.Linear. So convert them first.
+    model = copy.deepcopy(model)
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data.clone()
+                setattr(module, name, linear)
+
+    # Int8 weights, activations are quantized on the fly.
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class GPT2TracingWrapper(torch.nn.Module):
+
+    # Two entry points with plain tensors in and out. prefill runs the prompt. step runs a
+    # single token on top of the key value cache. The cache is a tuple of keys and values.
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.layers_number = model.config.n_layer
+
+    def prefill(self, input_ids, attention_mask, position_ids):
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=True, return_dict=True)
+        return outputs.logits[:, -1], self.__get_past(outputs.past_key_values)
+
+    def step(self, input_ids, attention_mask, position_ids, past):
+        cache = DynamicCache()
+        for layer_index in range(self.layers_number):
+            cache.update(past[2 * layer_index], past[2 * layer_index + 1], layer_index)
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache, use_cache=True, return_dict=True)
+        return outputs.logits[:, -1], self.__get_past(outputs.past_key_values)
+
+    def __get_past(self, cache):
+        past = []
+        for layer in cache.layers:
+            past += [layer.keys, layer.values]
+        return tuple(past)
+
+
+class GPT2OnnxWrapper(torch.nn.Module):
+
+    # The step of the tracing wrapper as forward. It also runs prompts on an empty cache.
+    def __init__(self, model):
+        super().__init__()
+        self.wrapper = GPT2TracingWrapper(model)
+
+    def forward(self, input_ids, attention_mask, position_ids, past):
+        return self.wrapper.step(input_ids, attention_mask, position_ids, past)
+
+
+def trace_model(model):
+    wrapper = GPT2TracingWrapper(model)
+    config = model.config
+
+    # Example inputs. Left padded, so that the trace covers the attention mask.
+    batch_size, prompt_length = 2, 5
+    input_ids = torch.zeros((batch_size, prompt_length), dtype=torch.long)
+    attention_mask = torch.ones((batch_size, prompt_length), dtype=torch.long)
+    attention_mask[0, :2] = 0
+    position_ids = get_position_ids(attention_mask)
+    head_size = config.n_embd // config.n_head
+    past = tuple(torch.zeros((batch_size, config.n_head, prompt_length, head_size)) for _ in range(2 * config.n_layer))
+    step_attention_mask = torch.cat([attention_mask, torch.ones((batch_size, 1), dtype=torch.long)], dim=1)
+
+    with torch.no_grad():
+        return torch.jit.trace_module(
+            wrapper,
+            {
+                "prefill": (input_ids, attention_mask, position_ids),
+                "step": (input_ids[:, :1], step_attention_mask, position_ids[:, -1:] + 1, past)
+            },
+            check_trace=False
+        )
+
+
+def get_position_ids(attention_mask):
+
+    # Positions start at the first token that is not padding.
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    return position_ids.masked_fill(attention_mask == 0, 1)
+
+
+class TorchScriptGPT2Model:
+
+    # Wraps a traced model. generate knows the arguments of the generate method of
+    # transformers that samplinghelpers uses and follows the same semantics.
+    def __init__(self, module, config):
+        self.module = module
+        self.config = config
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+    def generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        max_length=None,
+        max_new_tokens=None,
+        do_sample=False,
+        temperature=None,
+        top_k=None,
+        top_p=None,
+        num_return_sequences=1,
+        pad_token_id=None,
+        eos_token_id=None,
+        logits_processor=None,
+        stopping_criteria=None,
+        use_cache=True
+        ):
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if num_return_sequences > 1:
+            input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+            attention_mask = attention_mask.repeat_interleave(num_return_sequences, dim=0)
+        if max_new_tokens is None:
+            max_new_tokens = (max_length if max_length is not None else GENERATE_MAX_LENGTH_DEFAULT) - input_ids.shape[1]
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        eos_token_ids = torch.tensor(eos_token_id if eos_token_id is not None else [], dtype=torch.long)
+
+        # The same order as in transformers. First the given processors, then the warpers.
+        logits_processor = LogitsProcessorList(logits_processor if logits_processor is not None else [])
+        if do_sample:
+            if temperature is not None and temperature != 1.0:
+                logits_processor.append(TemperatureLogitsWarper(temperature))
+            top_k = top_k if top_k is not None else GENERATE_TOP_K_DEFAULT
+            if top_k != 0:
+                logits_processor.append(TopKLogitsWarper(top_k=top_k))
+            if top_p is not None and top_p < 1.0:
+                logits_processor.append(TopPLogitsWarper(top_p=top_p))
+        stopping_criteria = StoppingCriteriaList(stopping_criteria if stopping_criteria is not None else [])
+
+        with torch.no_grad():
+            logits, past = self.module.prefill(input_ids, attention_mask, get_position_ids(attention_mask))
+            unfinished = torch.ones(input_ids.shape[0], dtype=torch.bool)
+            for token_index in range(max_new_tokens):
+                if token_index != 0:
+                    position_ids = get_position_ids(attention_mask)[:, -1:]
+                    logits, past = self.module.step(input_ids[:, -1:], attention_mask, position_ids, past)
+
+                # Pick the next tokens. Finished sequences get padding.
+                scores = logits_processor(input_ids, logits.float())
+                if do_sample:
+                    next_token_ids = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+                else:
+                    next_token_ids = torch.argmax(scores, dim=-1)
+                if pad_token_id is not None:
+                    next_token_ids = torch.where(unfinished, next_token_ids, torch.full_like(next_token_ids, pad_token_id))
+                input_ids = torch.cat([input_ids, next_token_ids[:, None]], dim=1)
+                attention_mask = torch.cat([attention_mask, torch.ones_like(next_token_ids[:, None])], dim=1)
+
+                # Stop when all sequences are done.
+                unfinished &= ~torch.isin(next_token_ids, eos_token_ids)
+                if len(stopping_criteria) != 0:
+                    unfinished &= ~stopping_criteria(input_ids, scores)
+                if not unfinished.any():
+                    break
+        return input_ids
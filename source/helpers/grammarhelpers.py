@@ -0,0 +1,206 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+import torch
+from transformers import LogitsProcessor
+from source import logging
+
+logger = logging.create_logger("grammarhelpers")
+
+# The states of the MMM grammar. A piece looks like this:
+# PIECE_START (TRACK_START INST DENSITY (BAR_START (EVENT* | FILL_IN) BAR_END)+ TRACK_END)+
+# (FILL_START (EVENT* | FILL_IN) FILL_END)* PIECE_END
+STATE_START = 0
+STATE_PIECE = 1
+STATE_INST = 2
+STATE_DENSITY = 3
+STATE_FIRST_BAR = 4
+STATE_BAR = 5
+STATE_BAR_FILL_IN = 6
+STATE_BARS = 7
+STATE_FILL = 8
+STATE_FILL_FILL_IN = 9
+STATE_FILLS = 10
+STATE_END = 11
+STATES_NUMBER = 12
+
+# Token classes. Events and instrument and density tokens come with a value.
+TOKEN_CLASS_OTHER = "OTHER"
+TOKEN_CLASS_INST = "INST"
+TOKEN_CLASS_DENSITY = "DENSITY"
+TOKEN_CLASS_EVENT = "EVENT"
+EVENT_PREFIXES = ["NOTE_ON=", "NOTE_OFF=", "TIME_DELTA="]
+
+# Which token classes are allowed in which state.
+ALLOWED_TOKENS = {
+    STATE_START: ["PIECE_START"],
+    STATE_PIECE: ["TRACK_START", "FILL_START", "PIECE_END"],
+    STATE_INST: [TOKEN_CLASS_INST],
+    STATE_DENSITY: [TOKEN_CLASS_DENSITY],
+    STATE_FIRST_BAR: ["BAR_START"],
+    STATE_BAR: [TOKEN_CLASS_EVENT, "FILL_IN", "BAR_END"],
+    STATE_BAR_FILL_IN: ["BAR_END"],
+    STATE_BARS: ["BAR_START", "TRACK_END"],
+    STATE_FILL: [TOKEN_CLASS_EVENT, "FILL_IN", "FILL_END"],
+    STATE_FILL_FILL_IN: ["FILL_END"],
+    STATE_FILLS: ["FILL_START", "PIECE_END"],
+    STATE_END: []
+}
+
+# The stop tokens of sampling. Without a padding token they are allowed where nothing else is.
+STOP_TOKENS = ["PIECE_END", "TRACK_END"]
+
+# The state after a token. Everything that is not listed is not allowed.
+TRANSITIONS = {
+    (STATE_START, "PIECE_START"): STATE_PIECE,
+    (STATE_PIECE, "TRACK_START"): STATE_INST,
+    (STATE_PIECE, "FILL_START"): STATE_FILL,
+    (STATE_PIECE, "PIECE_END"): STATE_END,
+    (STATE_INST, TOKEN_CLASS_INST): STATE_DENSITY,
+    (STATE_DENSITY, TOKEN_CLASS_DENSITY): STATE_FIRST_BAR,
+    (STATE_FIRST_BAR, "BAR_START"): STATE_BAR,
+    (STATE_BAR, TOKEN_CLASS_EVENT): STATE_BAR,
+    (STATE_BAR, "FILL_IN"): STATE_BAR_FILL_IN,
+    (STATE_BAR, "BAR_END"): STATE_BARS,
+    (STATE_BAR_FILL_IN, "BAR_END"): STATE_BARS,
+    (STATE_BARS, "BAR_START"): STATE_BAR,
+    (STATE_BARS, "TRACK_END"): STATE_PIECE,
+    (STATE_FILL, TOKEN_CLASS_EVENT): STATE_FILL,
+    (STATE_FILL, "FILL_IN"): STATE_FILL_FILL_IN,
+    (STATE_FILL, "FILL_END"): STATE_FILLS,
+    (STATE_FILL_FILL_IN, "FILL_END"): STATE_FILLS,
+    (STATE_FILLS, "FILL_START"): STATE_FILL,
+    (STATE_FILLS, "PIECE_END"): STATE_END
+}
+
+
+def get_token_class(token):
+    if token.startswith("INST="):
+        return TOKEN_CLASS_INST
+    elif token.startswith("DENSITY="):
+        return TOKEN_CLASS_DENSITY
+    elif any(token.startswith(prefix) for prefix in EVENT_PREFIXES):
+        return TOKEN_CLASS_EVENT
+    elif token in ["[UNK]", "[CLS]", "[SEP]", "[PAD]", "[MASK]"]:
+        return TOKEN_CLASS_OTHER
+    else:
+        return token
+
+
+class MMMGrammar:
+
+    # The grammar over token ids. The vocabulary is a dict from token to id, for example from
+    # the get_vocab method of the tokenizer that has been loaded from tokenizer.json.
+    def __init__(self, vocabulary, pad_token="[PAD]", eos_token_ids=None):
+        self.vocabulary_size = max(vocabulary.values()) + 1
+        self.pad_token_id = vocabulary.get(pad_token, None)
+
+        # The tokens for states in which nothing is allowed. Padding, otherwise the stop tokens.
+        if self.pad_token_id is not None:
+            fallback_token_ids = [self.pad_token_id]
+        elif eos_token_ids is not None:
+            fallback_token_ids = [eos_token_ids] if isinstance(eos_token_ids, int) else list(eos_token_ids)
+        else:
+            fallback_token_ids = [vocabulary[token] for token in STOP_TOKENS if token in vocabulary]
+        if len(fallback_token_ids) == 0:
+            error_string = f"The vocabulary has neither the padding token {pad_token} nor stop tokens. Nothing would be allowed in the states that have no tokens in the vocabulary."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        # The class of each token id.
+        self.token_classes = [TOKEN_CLASS_OTHER] * self.vocabulary_size
+        for token, token_id in vocabulary.items():
+            self.token_classes[token_id] = get_token_class(token)
+
+        # The transition table over token ids. None means not allowed.
+        self.transitions = []
+        for state in range(STATES_NUMBER):
+            self.transitions += [[TRANSITIONS.get((state, token_class), None) for token_class in self.token_classes]]
+
+        # The allowed token ids in each state. If nothing is allowed, only the fallback tokens are.
+        # They do not change the state.
+        self.allowed_token_ids = []
+        self.fallback_token_ids = {}
+        for state in range(STATES_NUMBER):
+            allowed_token_ids = [token_id for token_id, token_class in enumerate(self.token_classes) if token_class in ALLOWED_TOKENS[state]]
+            if len(allowed_token_ids) == 0:
+                allowed_token_ids = fallback_token_ids
+                self.fallback_token_ids[state] = set(fallback_token_ids)
+            self.allowed_token_ids += [allowed_token_ids]
+
+    def get_next_state(self, state, token_id):
+
+        # Padding does not change the state. Neither does anything in the end state.
+        if token_id == self.pad_token_id or state == STATE_END or token_id in self.fallback_token_ids.get(state, ()):
+            return state
+        next_state = self.transitions[state][token_id] if token_id < self.vocabulary_size else None
+        if next_state is None:
+            raise Exception(f"Token {token_id} is not allowed in state {state}.")
+        return next_state
+
+    def get_state(self, token_ids, state=STATE_START):
+        for token_id in token_ids:
+            state = self.get_next_state(state, token_id)
+        return state
+
+    def is_valid(self, token_ids):
+        try:
+            self.get_state(token_ids)
+            return True
+        except Exception:
+            return False
+
+    def get_allowed_mask(self, scores_size, device):
+        mask = torch.zeros((STATES_NUMBER, scores_size), dtype=torch.bool, device=device)
+        for state, allowed_token_ids in enumerate(self.allowed_token_ids):
+            mask[state, [token_id for token_id in allowed_token_ids if token_id < scores_size]] = True
+        return mask
+
+
+class MMMGrammarLogitsProcessor(LogitsProcessor):
+
+    # Masks all tokens that would break the MMM grammar. The state of each sequence is updated
+    # with the new tokens only. If a sequence has been reordered, for example by beam search,
+    # its state is computed again from the start.
+    def __init__(self, vocabulary, pad_token="[PAD]", eos_token_ids=None):
+        self.grammar = MMMGrammar(vocabulary, pad_token=pad_token, eos_token_ids=eos_token_ids)
+        self.allowed_mask = None
+        self.states = None
+        self.last_token_ids = None
+        self.processed_length = 0
+
+    def __call__(self, input_ids, scores):
+
+        # Precompute the masks on the right device.
+        if self.allowed_mask is None or self.allowed_mask.shape[1] != scores.shape[-1] or self.allowed_mask.device != scores.device:
+            self.allowed_mask = self.grammar.get_allowed_mask(scores.shape[-1], scores.device)
+
+        # Update the states.
+        input_ids_list = input_ids.tolist()
+        if self.states is None or len(self.states) != len(input_ids_list) or self.processed_length > len(input_ids_list[0]):
+            self.states = [self.grammar.get_state(token_ids) for token_ids in input_ids_list]
+        else:
+            for index, token_ids in enumerate(input_ids_list):
+                if self.processed_length > 0 and token_ids[self.processed_length - 1] != self.last_token_ids[index]:
+                    self.states[index] = self.grammar.get_state(token_ids)
+                else:
+                    self.states[index] = self.grammar.get_state(token_ids[self.processed_length:], self.states[index])
+        self.processed_length = len(input_ids_list[0])
+        self.last_token_ids = [token_ids[-1] for token_ids in input_ids_list]
+
+        # Mask.
+        allowed_mask = self.allowed_mask[torch.tensor(self.states, device=scores.device)]
+        return scores.masked_fill(~allowed_mask, -float("inf"))
@@ -0,0 +1,64 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# The manifest of an incremental dataset build. It has the encoding config, the density bins
+# and for each split the songs in file order. Each song has its hash, its byte range and its
+# lines in the token sequences file and the tokens that it uses.
+
+import json
+import os
+
+MANIFEST_FILE = "manifest.json"
+
+# The config parameters that change the token sequences. If one of them changes, all songs are
+# encoded again.
+MANIFEST_CONFIG_FIELDS = [
+    "encoding_method",
+    "window_size_bars",
+    "hop_length_bars",
+    "density_bins_number",
+    "transpositions_train",
+    "permute_tracks",
+    "metadata_output"
+]
+
+
+def get_manifest_config(config):
+    return {field: getattr(config, field) for field in MANIFEST_CONFIG_FIELDS}
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest_path, manifest):
+
+    # Write to a temporary file first. An interrupted build never leaves half a manifest.
+    manifest_path_temporary = manifest_path + ".tmp"
+    with open(manifest_path_temporary, "w") as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path_temporary, manifest_path)
+
+
+def get_manifest_vocabulary(manifest):
+    vocabulary = set()
+    for songs in manifest["splits"].values():
+        for song in songs:
+            vocabulary.update(song["vocabulary"])
+    return vocabulary
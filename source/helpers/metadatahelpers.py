@@ -0,0 +1,123 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# The metadata of a token sequences file is stored next to it. One row per line with the song,
+# the bar window, the transposition, the order of the tracks, their instruments and densities.
+# Plus the byte offsets of the lines. PrimingStore in primingstorehelpers queries it.
+
+import os
+import numpy as np
+
+# Padding of the per track columns. And the fill columns of datasets without bar fill.
+TRACK_MISSING = -1
+FILL_MISSING = -1
+
+
+def get_metadata_path(data_path):
+    return os.path.splitext(data_path)[0] + "_metadata.npz"
+
+
+def save_index(index_path, **columns):
+
+    # Write to a temporary file first. Readers never see a half written index.
+    index_path_temporary = index_path + ".tmp"
+    with open(index_path_temporary, "wb") as file:
+        np.savez(file, **columns)
+    os.replace(index_path_temporary, index_path)
+
+
+def load_metadata(metadata_path):
+    with np.load(metadata_path) as metadata:
+        return {name: metadata[name] for name in metadata.files}
+
+
+def get_metadata_row(metadata, line_index):
+    song_index = metadata["song_indices"][line_index]
+    is_track = metadata["track_indices"][line_index] != TRACK_MISSING
+    return {
+        "song_number": str(metadata["song_numbers"][song_index]),
+        "song_title": str(metadata["song_titles"][song_index]),
+        "bar_start_index": int(metadata["bar_start_indices"][line_index]),
+        "bar_end_index": int(metadata["bar_end_indices"][line_index]),
+        "transposition": int(metadata["transpositions"][line_index]),
+        "track_indices": metadata["track_indices"][line_index][is_track].tolist(),
+        "instruments": metadata["instruments"][line_index][is_track].tolist(),
+        "densities": metadata["densities"][line_index][is_track].tolist(),
+        "fill_track_index": int(metadata["fill_track_indices"][line_index]),
+        "fill_bar_index": int(metadata["fill_bar_indices"][line_index])
+    }
+
+
+class MetadataWriter:
+
+    # Collects the metadata of the lines while they are written. save writes the columns.
+    def __init__(self):
+        self.songs = {}
+        self.offsets = []
+        self.lengths = []
+        self.song_indices = []
+        self.bar_start_indices = []
+        self.bar_end_indices = []
+        self.transpositions = []
+        self.track_indices = []
+        self.instruments = []
+        self.densities = []
+        self.fill_track_indices = []
+        self.fill_bar_indices = []
+
+    def add(self, metadata, offset, length):
+        song = (str(metadata["song_number"]), str(metadata["song_title"]))
+        self.songs.setdefault(song, len(self.songs))
+        self.offsets += [offset]
+        self.lengths += [length]
+        self.song_indices += [self.songs[song]]
+        self.bar_start_indices += [metadata["bar_start_index"]]
+        self.bar_end_indices += [metadata["bar_end_index"]]
+        self.transpositions += [metadata["transposition"]]
+        self.track_indices += [metadata["track_indices"]]
+        self.instruments += [metadata["instruments"]]
+        self.densities += [metadata["densities"]]
+        self.fill_track_indices += [metadata.get("fill_track_index", FILL_MISSING)]
+        self.fill_bar_indices += [metadata.get("fill_bar_index", FILL_MISSING)]
+
+    def save(self, metadata_path):
+
+        # The per track columns as matrices. One column per position in the token sequence.
+        tracks_number = max([len(track_indices) for track_indices in self.track_indices], default=0)
+        track_indices = np.full((len(self.offsets), tracks_number), TRACK_MISSING, dtype=np.int16)
+        instruments = np.full((len(self.offsets), tracks_number), "", dtype=object)
+        densities = np.full((len(self.offsets), tracks_number), TRACK_MISSING, dtype=np.int16)
+        for line_index, (line_track_indices, line_instruments, line_densities) in enumerate(zip(self.track_indices, self.instruments, self.densities)):
+            track_indices[line_index, :len(line_track_indices)] = line_track_indices
+            instruments[line_index, :len(line_instruments)] = line_instruments
+            densities[line_index, :len(line_densities)] = line_densities
+
+        save_index(
+            metadata_path,
+            offsets=np.array(self.offsets, dtype=np.int64),
+            lengths=np.array(self.lengths, dtype=np.int64),
+            song_numbers=np.array([song[0] for song in self.songs.keys()], dtype=str),
+            song_titles=np.array([song[1] for song in self.songs.keys()], dtype=str),
+            song_indices=np.array(self.song_indices, dtype=np.int32),
+            bar_start_indices=np.array(self.bar_start_indices, dtype=np.int32),
+            bar_end_indices=np.array(self.bar_end_indices, dtype=np.int32),
+            transpositions=np.array(self.transpositions, dtype=np.int16),
+            track_indices=track_indices,
+            instruments=instruments.astype(str),
+            densities=densities,
+            fill_track_indices=np.array(self.fill_track_indices, dtype=np.int16),
+            fill_bar_indices=np.array(self.fill_bar_indices, dtype=np.int32)
+        )
@@ -0,0 +1,132 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Writes standard MIDI files from note tables. No NoteSequence and no pretty_midi in between.
+# The files are laid out like the ones that note_seq writes. One track for the tempo and one
+# track per instrument, program and drums. Drums on channel 10, the rest on the other channels.
+
+import multiprocessing
+import os
+import struct
+import numpy as np
+from source import logging
+from source.helpers.noteseqhelpers import NOTE_LENGTH_16TH_120BPM
+from source.helpers.notetablehelpers import token_sequences_to_note_tables
+
+logger = logging.create_logger("midihelpers")
+
+# The same resolution as note_seq. A quarter note is four 16th notes.
+TICKS_PER_QUARTER = 220
+MICROSECONDS_PER_QUARTER = int(round(4 * NOTE_LENGTH_16TH_120BPM * 1000000))
+TICKS_PER_SECOND = TICKS_PER_QUARTER / (4 * NOTE_LENGTH_16TH_120BPM)
+DRUMS_CHANNEL = 9
+CHANNELS = [channel for channel in range(16) if channel != DRUMS_CHANNEL]
+
+
+def note_table_to_midi_bytes(note_table):
+
+    # The tempo track. 4/4 at 120 BPM.
+    tracks = [
+        encode_variable_length(0) + b"\xff\x51\x03" + MICROSECONDS_PER_QUARTER.to_bytes(3, "big") +
+        encode_variable_length(0) + b"\xff\x58\x04\x04\x02\x18\x08" +
+        encode_variable_length(0) + b"\xff\x2f\x00"
+    ]
+
+    # One track per instrument. Notes that are too short for a tick are left out. They would
+    # end before they start.
+    start_ticks = np.round(note_table["start_time"] * TICKS_PER_SECOND).astype(np.int64)
+    end_ticks = np.round(note_table["end_time"] * TICKS_PER_SECOND).astype(np.int64)
+    is_audible = end_ticks > start_ticks
+    instruments = np.unique(note_table[["instrument", "program", "is_drum"]][is_audible])
+    for instrument_index, (instrument, program, is_drum) in enumerate(instruments.tolist()):
+        is_instrument = is_audible & (note_table["instrument"] == instrument) & (note_table["program"] == program) & (note_table["is_drum"] == is_drum)
+        channel = DRUMS_CHANNEL if is_drum else CHANNELS[instrument_index % len(CHANNELS)]
+
+        # Note offs before note ons at the same tick. Then by pitch.
+        pitches = note_table["pitch"][is_instrument]
+        velocities = note_table["velocity"][is_instrument]
+        ticks = np.concatenate([end_ticks[is_instrument], start_ticks[is_instrument]])
+        statuses = np.concatenate([np.full(len(pitches), 0x80), np.full(len(pitches), 0x90)]) | channel
+        pitches = np.concatenate([pitches, pitches])
+        velocities = np.concatenate([np.zeros_like(velocities), velocities])
+        order = np.lexsort((velocities, pitches, statuses, ticks))
+        delta_ticks = np.diff(ticks[order], prepend=0)
+
+        track = bytearray(encode_variable_length(0) + bytes([0xc0 | channel, program & 0x7f]))
+        for delta_tick, status, pitch, velocity in zip(delta_ticks.tolist(), statuses[order].tolist(), pitches[order].tolist(), velocities[order].tolist()):
+            track += encode_variable_length(delta_tick)
+            track += bytes([status, pitch & 0x7f, velocity & 0x7f])
+        track += encode_variable_length(0) + b"\xff\x2f\x00"
+        tracks += [bytes(track)]
+
+    # Format 1 with all the tracks.
+    midi_bytes = b"MThd" + struct.pack(">IHHH", 6, 1, len(tracks), TICKS_PER_QUARTER)
+    for track in tracks:
+        midi_bytes += b"MTrk" + struct.pack(">I", len(track)) + track
+    return midi_bytes
+
+
+def encode_variable_length(value):
+    result = [value & 0x7f]
+    value >>= 7
+    while value != 0:
+        result += [0x80 | (value & 0x7f)]
+        value >>= 7
+    return bytes(reversed(result))
+
+
+def token_sequence_to_midi_file(token_sequence, path, use_program=True, use_drums=True):
+    note_table = token_sequences_to_note_tables([token_sequence], use_program=use_program, use_drums=use_drums)[0]
+    with open(path, "wb") as file:
+        file.write(note_table_to_midi_bytes(note_table))
+
+
+def export_midi_files(token_sequences, output_path, workers=1, chunk_size=256, use_program=True, use_drums=True, skip_invalid=True):
+
+    # Writes one MIDI file per token sequence into the output path. Returns the paths. With
+    # skip_invalid, token sequences that cannot be decoded are skipped and their path is None.
+    # The token sequences are decoded in chunks. Either in this process or sharded over a pool.
+    os.makedirs(output_path, exist_ok=True)
+    tasks = []
+    for chunk_start in range(0, len(token_sequences), chunk_size):
+        chunk = token_sequences[chunk_start:chunk_start + chunk_size]
+        tasks += [(chunk_start, chunk, output_path, use_program, use_drums, skip_invalid)]
+    if workers == 1:
+        paths = list(map(export_midi_files_chunk, tasks))
+    else:
+        logger.info(f"Exporting with {workers} workers and chunk size {chunk_size}.")
+        with multiprocessing.Pool(workers) as pool:
+            paths = list(pool.imap(export_midi_files_chunk, tasks))
+    paths = [path for chunk_paths in paths for path in chunk_paths]
+
+    skipped_number = sum(path is None for path in paths)
+    logger.info(f"Exported {len(paths) - skipped_number} MIDI files to {output_path}. Skipped {skipped_number}.")
+    return paths
+
+
+def export_midi_files_chunk(task):
+    chunk_start, token_sequences, output_path, use_program, use_drums, skip_invalid = task
+    note_tables = token_sequences_to_note_tables(token_sequences, use_program=use_program, use_drums=use_drums, skip_invalid=skip_invalid)
+    paths = []
+    for index, note_table in enumerate(note_tables, chunk_start):
+        if note_table is None:
+            paths += [None]
+            continue
+        path = os.path.join(output_path, f"{index:06d}.mid")
+        with open(path, "wb") as file:
+            file.write(note_table_to_midi_bytes(note_table))
+        paths += [path]
+    return paths
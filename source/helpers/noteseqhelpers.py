@@ -195,6 +195,20 @@ def empty_note_sequence(qpm=120.0, total_time=0.0):
     return note_sequence
 
 
+def note_table_to_note_sequence(note_table, qpm=120.0):
+    note_sequence = empty_note_sequence(qpm=qpm)
+    for pitch, start_time, end_time, instrument, program, velocity, is_drum in note_table.tolist():
+        note = note_sequence.notes.add()
+        note.start_time = start_time
+        note.end_time = end_time
+        note.pitch = pitch
+        note.instrument = instrument
+        note.program = program
+        note.velocity = velocity
+        note.is_drum = is_drum
+    return note_sequence
+
+
 def raise_exception_on_multiple_tempos(note_sequence):
     if len(note_sequence.tempos) != 1:
         error_message = f"Too many tempos: {len(note_sequence.tempos)}"
@@ -0,0 +1,264 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Decodes token sequences into note tables. A note table is a structured NumPy array with one
+# row per note. The notes are the same as the ones of token_sequence_to_note_sequence in
+# samplinghelpers, in the same order and with the same times.
+
+import numpy as np
+from source import logging
+from source.helpers.noteseqhelpers import NOTE_LENGTH_16TH_120BPM, BAR_LENGTH_120BPM
+
+logger = logging.create_logger("notetablehelpers")
+
+NOTE_TABLE_DTYPE = np.dtype([
+    ("pitch", np.int32),
+    ("start_time", np.float64),
+    ("end_time", np.float64),
+    ("instrument", np.int32),
+    ("program", np.int32),
+    ("velocity", np.int32),
+    ("is_drum", np.bool_)
+])
+NOTE_VELOCITY = 80
+
+# The opcodes of the tokens.
+OPCODE_IGNORE = 0
+OPCODE_PIECE_END = 1
+OPCODE_TRACK_START = 2
+OPCODE_INST = 3
+OPCODE_BAR_START = 4
+OPCODE_BAR_END = 5
+OPCODE_NOTE_ON = 6
+OPCODE_NOTE_OFF = 7
+OPCODE_TIME_DELTA = 8
+OPCODE_INVALID = 9
+
+# The argument of INST=DRUMS. And of an INST that is not a number. token_sequence_to_note_sequence
+# only fails on the latter when it needs the number.
+INSTRUMENT_DRUMS = -1
+INSTRUMENT_INVALID = np.nan
+
+# Time deltas in these units are exact. Then the times can be summed up in integers.
+TIME_UNITS_PER_SECOND = 2 ** 20
+
+
+
+class TokenCodes(dict):
+
+    # Maps tokens to codes. Each code has an opcode and an argument. New tokens are parsed once.
+    def __init__(self):
+        super().__init__()
+        self.opcodes = []
+        self.arguments = []
+
+    def __missing__(self, token):
+        code = len(self.opcodes)
+        opcode, argument = get_token_opcode(token)
+        self.opcodes += [opcode]
+        self.arguments += [argument]
+        self[token] = code
+        return code
+
+
+token_codes = TokenCodes()
+
+
+def get_token_opcode(token):
+
+    # Maps a token to its opcode and its argument. Tokens that cannot be parsed are invalid.
+    try:
+        if token in ["PIECE_START", "TRACK_END", "[PAD]"] or token.startswith("DENSITY="):
+            return OPCODE_IGNORE, 0.0
+        elif token == "PIECE_END":
+            return OPCODE_PIECE_END, 0.0
+        elif token == "TRACK_START":
+            return OPCODE_TRACK_START, 0.0
+        elif token.startswith("INST"):
+            instrument = token.split("=")[-1]
+            if instrument == "DRUMS":
+                return OPCODE_INST, INSTRUMENT_DRUMS
+            try:
+                return OPCODE_INST, int(instrument)
+            except ValueError:
+                return OPCODE_INST, INSTRUMENT_INVALID
+        elif token == "BAR_START":
+            return OPCODE_BAR_START, 0.0
+        elif token == "BAR_END":
+            return OPCODE_BAR_END, 0.0
+        elif token.startswith("NOTE_ON"):
+            return OPCODE_NOTE_ON, int(token.split("=")[-1])
+        elif token.startswith("NOTE_OFF"):
+            return OPCODE_NOTE_OFF, int(token.split("=")[-1])
+        elif token.startswith("TIME_DELTA"):
+            return OPCODE_TIME_DELTA, float(token.split("=")[-1]) * NOTE_LENGTH_16TH_120BPM
+    except ValueError:
+        pass
+    return OPCODE_INVALID, 0.0
+
+
+def create_token_table(vocabulary):
+
+    # The opcodes and arguments of all token ids. The vocabulary is a dict from token to id.
+    opcodes = np.full(max(vocabulary.values()) + 1, OPCODE_INVALID, dtype=np.int8)
+    arguments = np.zeros(max(vocabulary.values()) + 1, dtype=np.float64)
+    for token, token_id in vocabulary.items():
+        opcodes[token_id], arguments[token_id] = get_token_opcode(token)
+    return opcodes, arguments
+
+
+def token_sequence_to_note_table(token_sequence, use_program=True, use_drums=True, token_table=None):
+    return token_sequences_to_note_tables([token_sequence], use_program=use_program, use_drums=use_drums, token_table=token_table)[0]
+
+
+def token_sequences_to_note_tables(token_sequences, use_program=True, use_drums=True, token_table=None, skip_invalid=False):
+
+    # Decodes many token sequences at once. Each one is a string, a list of tokens or, with a
+    # token table, a list of token ids. Returns a note table per token sequence. Sequences that
+    # token_sequence_to_note_sequence cannot decode raise an exception. With skip_invalid
+    # their note table is None instead.
+    if token_table is not None:
+        token_ids = [np.asarray(token_sequence, dtype=np.int64) for token_sequence in token_sequences]
+        lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+        token_ids = np.concatenate(token_ids) if len(token_ids) != 0 else np.zeros(0, dtype=np.int64)
+        opcodes, arguments = token_table[0][token_ids], token_table[1][token_ids]
+    else:
+        token_sequences = [token_sequence.split() if isinstance(token_sequence, str) else token_sequence for token_sequence in token_sequences]
+        lengths = np.array([len(tokens) for tokens in token_sequences], dtype=np.int64)
+        tokens = [token for tokens in token_sequences for token in tokens]
+        codes = np.fromiter(map(token_codes.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+        opcodes = np.array(token_codes.opcodes, dtype=np.int8)[codes]
+        arguments = np.array(token_codes.arguments, dtype=np.float64)[codes]
+
+    # The sequence of each token and where it starts.
+    indices = np.arange(len(opcodes))
+    sequence_indices = np.repeat(np.arange(len(lengths)), lengths)
+    sequence_starts = (np.cumsum(lengths) - lengths)[sequence_indices]
+
+    # Everything from PIECE_END on is ignored.
+    piece_ends = np.cumsum(opcodes == OPCODE_PIECE_END)
+    piece_ends_before = np.concatenate([[0], piece_ends])[sequence_starts]
+    opcodes = np.where(piece_ends - piece_ends_before > 0, OPCODE_IGNORE, opcodes)
+
+    # The index of the last token of a kind in the same sequence. -1 if there is none.
+    def get_last_indices(mask):
+        last_indices = np.maximum.accumulate(np.where(mask, indices, -1))
+        return np.where(last_indices >= sequence_starts, last_indices, -1)
+
+    # The bar index is the number of BAR_END since the last TRACK_START.
+    bar_ends = np.cumsum(opcodes == OPCODE_BAR_END)
+    last_track_start_indices = get_last_indices(opcodes == OPCODE_TRACK_START)
+    bar_start_indices = np.flatnonzero(opcodes == OPCODE_BAR_START)
+    bar_start_track_start_indices = last_track_start_indices[bar_start_indices]
+    bar_indices = bar_ends[bar_start_indices] - bar_ends[bar_start_track_start_indices]
+    last_bar_start_indices = get_last_indices(opcodes == OPCODE_BAR_START)
+    times = get_times(opcodes, arguments, bar_start_indices, bar_indices * BAR_LENGTH_120BPM, last_bar_start_indices)
+
+    # Instrument, program and drums. With use_drums, a drums INST sets all of them. Another INST
+    # sets the instrument, and with use_program the program. Before that, program 1 without drums.
+    is_inst = opcodes == OPCODE_INST
+    is_drums = is_inst & (arguments == INSTRUMENT_DRUMS)
+    is_instrument_invalid = is_inst & np.isnan(arguments)
+    arguments = np.where(np.isnan(arguments), 0.0, arguments)
+    last_inst_indices = get_last_indices(is_inst)
+    is_program = (is_drums & use_drums) | (is_inst & ~is_drums & use_program)
+    last_program_indices = get_last_indices(is_program)
+    has_program = last_program_indices != -1
+    programs = np.where(is_drums, 0, arguments).astype(np.int32)
+    instruments = np.where(is_drums, 0, arguments).astype(np.int32)
+
+    # The notes.
+    note_on_indices = np.flatnonzero(opcodes == OPCODE_NOTE_ON)
+    note_inst_indices = last_inst_indices[note_on_indices]
+    note_program_indices = last_program_indices[note_on_indices]
+    note_table = np.zeros(len(note_on_indices), dtype=NOTE_TABLE_DTYPE)
+    note_table["pitch"] = arguments[note_on_indices]
+    note_table["start_time"] = times[note_on_indices]
+    note_table["end_time"] = times[note_on_indices] + 4 * NOTE_LENGTH_16TH_120BPM
+    note_table["instrument"] = instruments[note_inst_indices]
+    note_table["program"] = np.where(has_program[note_on_indices], programs[note_program_indices], 1)
+    note_table["velocity"] = NOTE_VELOCITY
+    note_table["is_drum"] = has_program[note_on_indices] & is_drums[note_program_indices]
+
+    # A NOTE_OFF ends the last NOTE_ON with the same pitch since the last BAR_START.
+    # If there are more NOTE_OFF for the same note, the last one counts.
+    pitch_indices = np.flatnonzero(((opcodes == OPCODE_NOTE_ON) | (opcodes == OPCODE_NOTE_OFF)) & (last_bar_start_indices != -1))
+    order = np.lexsort((pitch_indices, arguments[pitch_indices], last_bar_start_indices[pitch_indices]))
+    pitch_indices = pitch_indices[order]
+    is_note_on = opcodes[pitch_indices] == OPCODE_NOTE_ON
+    groups = np.stack([last_bar_start_indices[pitch_indices], arguments[pitch_indices]])
+    is_group_start = np.ones(len(pitch_indices), dtype=np.bool_)
+    is_group_start[1:] = np.any(groups[:, 1:] != groups[:, :-1], axis=0)
+
+    # The note of each token. NOTE_OFF without NOTE_ON in their group have none.
+    note_numbers = np.searchsorted(note_on_indices, pitch_indices)
+    positions = np.arange(len(pitch_indices))
+    group_starts = np.maximum.accumulate(np.where(is_group_start, positions, 0))
+    last_note_on_positions = np.maximum.accumulate(np.where(is_note_on, positions, -1))
+    has_owner = last_note_on_positions >= group_starts
+    owners = np.where(has_owner, note_numbers[np.maximum(last_note_on_positions, 0)], -1)
+
+    # The last NOTE_OFF of each note.
+    is_last_note_off = ~is_note_on & has_owner
+    is_last_note_off[:-1] &= owners[1:] != owners[:-1]
+    note_table["end_time"][owners[is_last_note_off]] = times[pitch_indices[is_last_note_off]]
+
+    # The tokens that token_sequence_to_note_sequence fails on.
+    errors = [
+        (opcodes == OPCODE_INVALID, "Invalid token"),
+        ((opcodes == OPCODE_BAR_START) & (last_track_start_indices == -1), "BAR_START before TRACK_START"),
+        ((opcodes == OPCODE_BAR_END) & (last_track_start_indices == -1), "BAR_END before TRACK_START"),
+        (np.isin(opcodes, [OPCODE_NOTE_ON, OPCODE_NOTE_OFF, OPCODE_TIME_DELTA]) & (last_bar_start_indices == -1), "Notes or time deltas before BAR_START"),
+        ((opcodes == OPCODE_NOTE_ON) & (last_inst_indices == -1), "NOTE_ON before INST"),
+        (is_instrument_invalid & use_program, "Invalid instrument"),
+        ((opcodes == OPCODE_NOTE_ON) & is_instrument_invalid[last_inst_indices] & (last_inst_indices != -1), "Invalid instrument"),
+        ((opcodes == OPCODE_NOTE_ON) & is_drums[last_inst_indices] & (last_inst_indices != -1) & (not use_drums), "Drums without use_drums")
+    ]
+    is_invalid = np.zeros(len(lengths), dtype=np.bool_)
+    for mask, error_string in errors:
+        if np.any(mask) and not skip_invalid:
+            token_index = np.flatnonzero(mask)[0]
+            error_string = f"{error_string} in token sequence {sequence_indices[token_index]} at index {token_index - sequence_starts[token_index]}."
+            logger.error(error_string)
+            raise Exception(error_string)
+        is_invalid[sequence_indices[mask]] = True
+
+    # Split into the sequences.
+    note_counts = np.bincount(sequence_indices[note_on_indices], minlength=len(lengths))
+    note_tables = np.split(note_table, np.cumsum(note_counts)[:-1]) if len(lengths) != 0 else []
+    return [None if invalid else table for table, invalid in zip(note_tables, is_invalid)]
+
+
+def get_times(opcodes, arguments, bar_start_indices, bar_start_times, last_bar_start_indices):
+
+    # The time at each token. Like current_time in token_sequence_to_note_sequence. It starts
+    # at each BAR_START and is moved by TIME_DELTA. Before the first BAR_START it is zero.
+    increments = np.where(opcodes == OPCODE_TIME_DELTA, arguments, 0.0)
+    increments[bar_start_indices] = bar_start_times
+    units = increments * TIME_UNITS_PER_SECOND
+
+    # If all times are exact in floating point, sum up integers. Otherwise sum up bar by bar
+    # in the same order as before, so that the rounding is the same.
+    if np.all(units == np.round(units)) and np.sum(np.abs(units)) < 2 ** 52:
+        units = units.astype(np.int64)
+        sums = np.cumsum(units)
+        has_bar_start = last_bar_start_indices != -1
+        bar_start_sums = sums[last_bar_start_indices] - units[last_bar_start_indices]
+        return np.where(has_bar_start, sums - bar_start_sums, 0) / TIME_UNITS_PER_SECOND
+    times = np.zeros(len(opcodes), dtype=np.float64)
+    for start, end in zip(bar_start_indices, list(bar_start_indices[1:]) + [len(opcodes)]):
+        times[start:end] = np.cumsum(increments[start:end])
+    return times
@@ -0,0 +1,216 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Sampling with onnxruntime and NumPy. Does not import torch or transformers.
+# Export the model with python -m source.export --onnx first.
+
+import json
+import os
+import time
+import numpy as np
+import onnxruntime
+from tokenizers import Tokenizer
+from source import logging
+
+logger = logging.create_logger("onnxsamplinghelpers")
+
+ONNX_MODEL_FILE = "model.onnx"
+
+# The defaults of generate in transformers.
+GENERATE_TOP_K_DEFAULT = 50
+
+
+class OnnxGPT2Model:
+
+    # The exported model plus the sizes of its key value cache.
+    def __init__(self, model_path, threads=None):
+        with open(os.path.join(model_path, "config.json"), "r") as file:
+            config = json.load(file)
+        self.layers_number = config["n_layer"]
+        self.heads_number = config["n_head"]
+        self.head_size = config["n_embd"] // config["n_head"]
+
+        session_options = onnxruntime.SessionOptions()
+        if threads is not None:
+            session_options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_path, ONNX_MODEL_FILE),
+            session_options,
+            providers=["CPUExecutionProvider"]
+        )
+
+    def get_empty_past(self, batch_size):
+        shape = (batch_size, self.heads_number, 0, self.head_size)
+        return [np.zeros(shape, dtype=np.float32) for _ in range(2 * self.layers_number)]
+
+    def forward(self, input_ids, attention_mask, position_ids, past):
+
+        # Returns the logits of the last position and the new cache.
+        inputs = {
+            "input_ids": input_ids.astype(np.int64),
+            "attention_mask": attention_mask.astype(np.int64),
+            "position_ids": position_ids.astype(np.int64)
+        }
+        for layer_index in range(self.layers_number):
+            inputs[f"past_key_values.{layer_index}.key"] = past[2 * layer_index]
+            inputs[f"past_key_values.{layer_index}.value"] = past[2 * layer_index + 1]
+        outputs = self.session.run(None, inputs)
+        return outputs[0], outputs[1:]
+
+
+def load_onnx_model(model_path, tokenizer_path, threads=None):
+    model = OnnxGPT2Model(model_path, threads=threads)
+    tokenizer = Tokenizer.from_file(tokenizer_path)
+    return model, tokenizer
+
+
+def get_position_ids(attention_mask):
+
+    # Positions start at the first token that is not padding.
+    position_ids = np.cumsum(attention_mask, axis=-1) - 1
+    position_ids[attention_mask == 0] = 1
+    return position_ids
+
+
+def process_logits(scores, temperature=None, top_k=None, top_p=None):
+
+    # The warpers of transformers in the same order. Removed tokens get -inf.
+    scores = scores.astype(np.float32)
+    if temperature is not None and temperature != 1.0:
+        scores = scores / temperature
+    top_k = top_k if top_k is not None else GENERATE_TOP_K_DEFAULT
+    if top_k != 0:
+        top_k = min(top_k, scores.shape[-1])
+        kth_scores = -np.sort(-scores, axis=-1)[:, top_k - 1:top_k]
+        scores = np.where(scores < kth_scores, -np.inf, scores)
+    if top_p is not None and top_p < 1.0:
+
+        # Remove the tokens with the lowest probabilities that together have at most 1 - top_p.
+        # The most probable token always stays.
+        sorted_indices = np.argsort(scores, axis=-1, kind="stable")
+        sorted_scores = np.take_along_axis(scores, sorted_indices, axis=-1)
+        cumulative_probabilities = np.cumsum(softmax(sorted_scores), axis=-1)
+        sorted_indices_to_remove = cumulative_probabilities <= (1 - top_p)
+        sorted_indices_to_remove[:, -1] = False
+        indices_to_remove = np.zeros_like(sorted_indices_to_remove)
+        np.put_along_axis(indices_to_remove, sorted_indices, sorted_indices_to_remove, axis=-1)
+        scores = np.where(indices_to_remove, -np.inf, scores)
+    return scores
+
+
+def softmax(scores):
+    scores = scores - np.max(scores, axis=-1, keepdims=True)
+    exponentials = np.exp(scores)
+    return exponentials / np.sum(exponentials, axis=-1, keepdims=True)
+
+
+def generate_batch_onnx(
+    model,
+    tokenizer,
+    token_sequences,
+    num_return_sequences=1,
+    max_length=1000,
+    max_new_tokens=None,
+    temperature=0.9,
+    top_k=None,
+    top_p=None,
+    do_sample=True,
+    stop_tokens=["PIECE_END", "TRACK_END"],
+    stop_tokens_count=1,
+    batch_size=32,
+    seed=None,
+    return_statistics=False
+    ):
+
+    # The same as generate_batch in samplinghelpers. model and tokenizer come from load_onnx_model.
+    # Returns a list of num_return_sequences token sequences per priming sequence.
+    random_generator = np.random.default_rng(seed)
+    vocabulary = tokenizer.get_vocab()
+    stop_token_ids = np.array([vocabulary[token] for token in stop_tokens if token in vocabulary], dtype=np.int64)
+    pad_token_id = vocabulary["[PAD]"]
+
+    generated_sequences = []
+    generated_tokens_count = 0
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(token_sequences), batch_size):
+        batch_token_sequences = token_sequences[batch_start:batch_start + batch_size]
+
+        # Left pad, so that all sequences continue at the same position.
+        encodings = tokenizer.encode_batch(batch_token_sequences)
+        input_length = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.full((len(encodings), input_length), pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), input_length), dtype=np.int64)
+        for index, encoding in enumerate(encodings):
+            if len(encoding.ids) != 0:
+                input_ids[index, -len(encoding.ids):] = encoding.ids
+                attention_mask[index, -len(encoding.ids):] = 1
+        input_ids = np.repeat(input_ids, num_return_sequences, axis=0)
+        attention_mask = np.repeat(attention_mask, num_return_sequences, axis=0)
+
+        # The first step runs the prompt on an empty cache. Then one token at a time.
+        new_tokens_number = max_new_tokens if max_new_tokens is not None else max_length - input_length
+        past = model.get_empty_past(input_ids.shape[0])
+        step_input_ids = input_ids
+        stop_tokens_found = np.zeros(input_ids.shape[0], dtype=np.int64)
+        unfinished = np.ones(input_ids.shape[0], dtype=bool)
+        for _ in range(new_tokens_number):
+            position_ids = get_position_ids(attention_mask)[:, -step_input_ids.shape[1]:]
+            logits, past = model.forward(step_input_ids, attention_mask, position_ids, past)
+
+            # Pick the next tokens. Finished sequences get padding.
+            if do_sample:
+                probabilities = softmax(process_logits(logits, temperature, top_k, top_p))
+                cumulative_probabilities = np.cumsum(probabilities, axis=-1)
+                random_values = random_generator.random((probabilities.shape[0], 1)) * cumulative_probabilities[:, -1:]
+                next_token_ids = np.argmax(cumulative_probabilities > random_values, axis=-1)
+            else:
+                next_token_ids = np.argmax(logits, axis=-1)
+            next_token_ids = np.where(unfinished, next_token_ids, pad_token_id).astype(np.int64)
+            input_ids = np.concatenate([input_ids, next_token_ids[:, None]], axis=1)
+            attention_mask = np.concatenate([attention_mask, np.ones((attention_mask.shape[0], 1), dtype=np.int64)], axis=1)
+            step_input_ids = next_token_ids[:, None]
+
+            # Stop when all sequences have enough stop tokens.
+            stop_tokens_found += np.isin(next_token_ids, stop_token_ids) & unfinished
+            unfinished &= stop_tokens_found < stop_tokens_count
+            if not unfinished.any():
+                break
+
+        # Decode. Remove the padding and everything after the last requested stop token.
+        for sequence_index in range(len(batch_token_sequences)):
+            sequences = []
+            for output_index in range(num_return_sequences):
+                ids = input_ids[sequence_index * num_return_sequences + output_index].tolist()
+                new_ids = [token_id for token_id in ids[input_length:] if token_id != pad_token_id]
+                generated_tokens_count += len(new_ids)
+                ids = [token_id for token_id in ids[:input_length] if token_id != pad_token_id] + new_ids
+                sequences += [" ".join(tokenizer.id_to_token(token_id) for token_id in ids)]
+            generated_sequences += [sequences]
+
+    # Report the throughput.
+    duration = time.perf_counter() - start_time
+    statistics = {
+        "sequences": len(token_sequences) * num_return_sequences,
+        "generated_tokens": generated_tokens_count,
+        "duration": duration,
+        "tokens_per_second": generated_tokens_count / duration if duration > 0 else 0.0
+    }
+    logger.info(f"Generated {generated_tokens_count} tokens in {duration:.2f}s, {statistics['tokens_per_second']:.1f} tokens/s.")
+
+    if not return_statistics:
+        return generated_sequences
+    else:
+        return generated_sequences, statistics
@@ -0,0 +1,214 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+import os
+import random
+import re
+import numpy as np
+from source import logging
+from source.helpers.metadatahelpers import TRACK_MISSING, get_metadata_path, get_metadata_row, load_metadata, save_index
+
+# The index of a token sequences file is stored next to it. It has the byte offsets of the
+# lines and the density of the first track of each instrument in each line. Datasets that were
+# created with metadata_output have all of that in their metadata. Then no index is needed.
+logger = logging.create_logger("primingstorehelpers")
+
+PRIMING_INDEX_BUFFER_SIZE = 1024 * 1024
+INSTRUMENT_DENSITY_PATTERN = re.compile(rb"INST=(\S+)(?: DENSITY=(\d+))?")
+DENSITY_MISSING = -1
+INSTRUMENT_MISSING = -2
+
+
+def get_priming_index_path(data_path):
+    return os.path.splitext(data_path)[0] + "_index.npz"
+
+
+def is_priming_index_valid(data_path, index_path):
+    if not os.path.exists(index_path):
+        return False
+    return os.path.getmtime(index_path) >= os.path.getmtime(data_path)
+
+
+def create_priming_index(data_path):
+
+    # One pass over the file. Empty lines are skipped.
+    offsets, lengths, lines_densities = [], [], []
+    instruments = {}
+    with open(data_path, "rb", buffering=PRIMING_INDEX_BUFFER_SIZE) as file:
+        offset = 0
+        for line in file:
+            if line.strip() != b"":
+                densities = {}
+                for instrument, density in INSTRUMENT_DENSITY_PATTERN.findall(line):
+                    instrument = instrument.decode("utf-8")
+                    instruments.setdefault(instrument, len(instruments))
+                    densities.setdefault(instrument, int(density) if density != b"" else DENSITY_MISSING)
+                offsets += [offset]
+                lengths += [len(line)]
+                lines_densities += [densities]
+            offset += len(line)
+
+    # The densities as a matrix. One column per instrument.
+    densities = np.full((len(offsets), len(instruments)), INSTRUMENT_MISSING, dtype=np.int16)
+    for line_index, line_densities in enumerate(lines_densities):
+        for instrument, density in line_densities.items():
+            densities[line_index, instruments[instrument]] = density
+
+    return {
+        "offsets": np.array(offsets, dtype=np.int64),
+        "lengths": np.array(lengths, dtype=np.int64),
+        "instruments": np.array(list(instruments.keys()), dtype=str),
+        "densities": densities
+    }
+
+
+def load_priming_index(data_path, index_path):
+
+    # Creates the index if it is missing or outdated. If it cannot be written, for example in a
+    # read only dataset directory, it is kept in memory only.
+    if is_priming_index_valid(data_path, index_path):
+        with np.load(index_path) as index:
+            return {name: index[name] for name in index.files}
+    index = create_priming_index(data_path)
+    try:
+        save_index(index_path, **index)
+    except OSError as error:
+        logger.warning(f"Could not write the priming index {index_path}: {error}. Keeping it in memory.")
+    return index
+
+
+def get_metadata_densities(metadata):
+
+    # The densities matrix of the index from the per track columns of the metadata. If an
+    # instrument has more tracks, the first one counts.
+    instruments = {}
+    for instrument in metadata["instruments"][metadata["track_indices"] != TRACK_MISSING].tolist():
+        instruments.setdefault(instrument, len(instruments))
+    densities = np.full((len(metadata["offsets"]), len(instruments)), INSTRUMENT_MISSING, dtype=np.int16)
+    for position in reversed(range(metadata["instruments"].shape[1])):
+        is_track = metadata["track_indices"][:, position] != TRACK_MISSING
+        for instrument, column in instruments.items():
+            mask = is_track & (metadata["instruments"][:, position] == instrument)
+            densities[mask, column] = metadata["densities"][mask, position]
+    return instruments, densities
+
+
+class PrimingStore:
+
+    # Random access to the lines of a token sequences file. The offsets and densities come from
+    # the metadata if it is there. Otherwise the index is created once and then loaded from disk.
+    # Without write access the index is created in memory each time.
+    # Reading a line seeks to it and reads only that line.
+    def __init__(self, data_path, index_path=None):
+        self.data_path = data_path
+        self.metadata = None
+        metadata_path = get_metadata_path(data_path)
+        if index_path is None and is_priming_index_valid(data_path, metadata_path):
+            self.index_path = metadata_path
+            self.metadata = load_metadata(metadata_path)
+            self.offsets = self.metadata["offsets"]
+            self.lengths = self.metadata["lengths"]
+            self.instruments, self.densities = get_metadata_densities(self.metadata)
+        else:
+            self.index_path = index_path if index_path is not None else get_priming_index_path(data_path)
+            index = load_priming_index(data_path, self.index_path)
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"]
+            self.instruments = {str(instrument): column for column, instrument in enumerate(index["instruments"])}
+            self.densities = index["densities"]
+        self.data_mtime = os.path.getmtime(data_path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def is_outdated(self):
+        return os.path.getmtime(self.data_path) != self.data_mtime
+
+    def get_token_sequence(self, line_index):
+        with open(self.data_path, "rb") as file:
+            file.seek(self.offsets[line_index])
+            return file.read(self.lengths[line_index]).decode("utf-8").strip()
+
+    def get_token_sequences(self, line_indices):
+
+        # In file order, so that the reads only go forward. Returned in the given order.
+        token_sequences = {}
+        with open(self.data_path, "rb") as file:
+            for line_index in sorted(set(int(line_index) for line_index in line_indices)):
+                file.seek(self.offsets[line_index])
+                token_sequences[line_index] = file.read(self.lengths[line_index]).decode("utf-8").strip()
+        return [token_sequences[int(line_index)] for line_index in line_indices]
+
+    def get_metadata(self, line_index):
+        self.__check_metadata()
+        return get_metadata_row(self.metadata, line_index)
+
+    def get_line_indices(self, instrument=None, density=None, song_number=None, song_title=None, bar_start_index=None, transposition=None):
+
+        # The lines with a track of the instrument. With a density, the track must have it.
+        # With only a density, any track with that density will do.
+        densities = self.densities
+        if instrument is not None:
+            if str(instrument) not in self.instruments:
+                return np.zeros(0, dtype=np.int64)
+            column = self.instruments[str(instrument)]
+            densities = densities[:, column:column + 1]
+        if density is not None:
+            mask = np.any(densities == int(density), axis=1)
+        else:
+            mask = np.any(densities != INSTRUMENT_MISSING, axis=1)
+
+        # The song, the window and the transposition need the metadata.
+        if song_number is not None or song_title is not None or bar_start_index is not None or transposition is not None:
+            self.__check_metadata()
+        if song_number is not None or song_title is not None:
+            is_song = np.ones(len(self.metadata["song_numbers"]), dtype=bool)
+            if song_number is not None:
+                is_song &= self.metadata["song_numbers"] == str(song_number)
+            if song_title is not None:
+                is_song &= self.metadata["song_titles"] == str(song_title)
+            mask &= np.isin(self.metadata["song_indices"], np.flatnonzero(is_song))
+        if bar_start_index is not None:
+            mask &= self.metadata["bar_start_indices"] == bar_start_index
+        if transposition is not None:
+            mask &= self.metadata["transpositions"] == transposition
+        return np.flatnonzero(mask)
+
+    def get_random_token_sequence(self, instrument=None, density=None):
+        if instrument is None and density is None:
+            line_index = random.randrange(len(self))
+        else:
+            line_indices = self.get_line_indices(instrument, density)
+            if len(line_indices) == 0:
+                raise Exception(f"No token sequence with instrument {instrument} and density {density} in {self.data_path}.")
+            line_index = line_indices[random.randrange(len(line_indices))]
+        return self.get_token_sequence(line_index)
+
+    def __check_metadata(self):
+        if self.metadata is None:
+            raise Exception(f"No metadata for {self.data_path}. Create the dataset with metadata_output=True.")
+
+
+# The stores of get_priming_store. So that each index is loaded only once.
+priming_stores = {}
+
+
+def get_priming_store(data_path):
+    store = priming_stores.get(data_path, None)
+    if store is None or store.is_outdated():
+        store = PrimingStore(data_path)
+        priming_stores[data_path] = store
+    return store
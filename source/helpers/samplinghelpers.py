@@ -15,12 +15,21 @@
 # Lint as: python3
 
 import note_seq
-import random
+import time
+import torch
+from transformers import LogitsProcessorList, PreTrainedModel, StoppingCriteria, StoppingCriteriaList
+from source import logging
+from source.helpers.grammarhelpers import MMMGrammarLogitsProcessor
 from source.helpers.noteseqhelpers import (
     empty_note_sequence,
+    note_table_to_note_sequence,
     NOTE_LENGTH_16TH_120BPM,
     BAR_LENGTH_120BPM
 )
+from source.helpers.notetablehelpers import token_sequences_to_note_tables
+from source.helpers.primingstorehelpers import get_priming_store
+
+logger = logging.create_logger("samplinghelpers")
 
 
 def render_token_sequence(token_sequence, use_program=True, use_drums=True):
@@ -59,11 +68,11 @@ def print_token_sequence(token_sequence, priming_samples_number=None):
     print(result)
 
 
-def get_priming_token_sequence(data_path, stop_on_track_end=None, stop_after_n_tokens=None, return_original=False):
+def get_priming_token_sequence(data_path, stop_on_track_end=None, stop_after_n_tokens=None, return_original=False, instrument=None, density=None):
 
-    # Get a random token sequence from the file.
-    lines = open(data_path, "r").readlines()
-    token_sequence = random.choice(lines)
+    # Get a random token sequence from the file. Optionally one with a track of the instrument
+    # and/or the density. Uses an index of the lines, so only the chosen line is read.
+    token_sequence = get_priming_store(data_path).get_random_token_sequence(instrument=instrument, density=density)
 
     result_tokens = []
     track_end_index = 0
@@ -86,11 +95,16 @@ def get_priming_token_sequence(data_path, stop_on_track_end=None, stop_after_n_t
         return result, token_sequence
 
 
-def generate(model, tokenizer, token_sequence):
+def generate(model, tokenizer, token_sequence, use_grammar=False):
 
     # Map token sequence to ids.
     input_ids = tokenizer.encode(token_sequence, return_tensors="pt")
 
+    # Only generate tokens that keep the sequence valid.
+    generate_kwargs = {}
+    if use_grammar:
+        generate_kwargs["logits_processor"] = LogitsProcessorList([MMMGrammarLogitsProcessor(tokenizer.get_vocab())])
+
     generated_sequence = model.generate(
         input_ids,
         #min_length=200,
@@ -100,11 +114,329 @@ def generate(model, tokenizer, token_sequence):
         #bos_token_id=tokenizer.token_to_id("PIECE_START"),
         #eos_token_id=tokenizer.token_to_id("PIECE_END"),
         #bad_words_ids=[[tokenizer.token_to_id("[PAD]")], [tokenizer.token_to_id("[MASK]")]]
+        **generate_kwargs
     )
     generated_sequence = tokenizer.decode(generated_sequence[0])
     return generated_sequence
 
 
+def generate_batch(
+    model,
+    tokenizer,
+    token_sequences,
+    num_return_sequences=1,
+    max_length=1000,
+    max_new_tokens=None,
+    temperature=0.9,
+    top_k=None,
+    top_p=None,
+    do_sample=True,
+    stop_tokens=["PIECE_END", "TRACK_END"],
+    stop_tokens_count=1,
+    batch_size=32,
+    use_grammar=False,
+    return_statistics=False
+    ):
+
+    # Generates continuations for many priming sequences. Returns a list of
+    # num_return_sequences token sequences per priming sequence. Each sequence
+    # stops after stop_tokens_count of the stop tokens have been generated.
+    vocabulary = tokenizer.get_vocab()
+    stop_token_ids = [vocabulary[token] for token in stop_tokens if token in vocabulary]
+    pad_token_id = tokenizer.pad_token_id
+
+    # Left pad, so that all sequences in a batch continue at the same position.
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+
+    generated_sequences = []
+    generated_tokens_count = 0
+    start_time = time.perf_counter()
+    try:
+        for batch_start in range(0, len(token_sequences), batch_size):
+            batch_token_sequences = token_sequences[batch_start:batch_start + batch_size]
+            inputs = tokenizer(batch_token_sequences, padding=True, return_tensors="pt")
+            input_length = inputs["input_ids"].shape[1]
+
+            # Only generate tokens that keep the sequences valid.
+            generate_kwargs = {}
+            if use_grammar:
+                generate_kwargs["logits_processor"] = LogitsProcessorList([MMMGrammarLogitsProcessor(vocabulary, eos_token_ids=stop_token_ids)])
+
+            # A single stop token is an end of sequence token. Otherwise count them.
+            if stop_tokens_count == 1:
+                generate_kwargs["eos_token_id"] = stop_token_ids
+            else:
+                generate_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                    StopTokensCountCriteria(stop_token_ids, stop_tokens_count, input_length)
+                ])
+
+            # One generate call for the whole batch. Uses the key value cache.
+            with torch.no_grad():
+                output_ids = model.generate(
+                    inputs["input_ids"],
+                    attention_mask=inputs["attention_mask"],
+                    max_length=max_length if max_new_tokens is None else None,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=do_sample,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    num_return_sequences=num_return_sequences,
+                    pad_token_id=pad_token_id,
+                    use_cache=True,
+                    **generate_kwargs
+                )
+
+            # Decode. Remove the padding and everything after the last requested stop token.
+            output_ids = output_ids.tolist()
+            for sequence_index in range(len(batch_token_sequences)):
+                sequences = []
+                for output_index in range(num_return_sequences):
+                    ids = output_ids[sequence_index * num_return_sequences + output_index]
+                    new_ids = ids[input_length:]
+                    stop_tokens_found = 0
+                    for token_index, token_id in enumerate(new_ids):
+                        if token_id in stop_token_ids:
+                            stop_tokens_found += 1
+                        if stop_tokens_found == stop_tokens_count:
+                            new_ids = new_ids[:token_index + 1]
+                            break
+                    new_ids = [token_id for token_id in new_ids if token_id != pad_token_id]
+                    generated_tokens_count += len(new_ids)
+                    ids = [token_id for token_id in ids[:input_length] if token_id != pad_token_id] + new_ids
+                    sequences += [" ".join(tokenizer.convert_ids_to_tokens(ids))]
+                generated_sequences += [sequences]
+    finally:
+        tokenizer.padding_side = padding_side
+
+    # Report the throughput.
+    duration = time.perf_counter() - start_time
+    statistics = {
+        "sequences": len(token_sequences) * num_return_sequences,
+        "generated_tokens": generated_tokens_count,
+        "duration": duration,
+        "tokens_per_second": generated_tokens_count / duration if duration > 0 else 0.0
+    }
+    logger.info(f"Generated {generated_tokens_count} tokens in {duration:.2f}s, {statistics['tokens_per_second']:.1f} tokens/s.")
+
+    if not return_statistics:
+        return generated_sequences
+    else:
+        return generated_sequences, statistics
+
+
+def generate_tracks(model, tokenizer, token_sequences, tracks_number=1, **kwargs):
+
+    # Continues each priming sequence with the given number of tracks. MMMTrack.
+    return generate_batch(
+        model,
+        tokenizer,
+        token_sequences,
+        stop_tokens=["TRACK_END", "PIECE_END"],
+        stop_tokens_count=tracks_number,
+        **kwargs
+    )
+
+
+def generate_bar_fill(model, tokenizer, token_sequences, **kwargs):
+
+    # Generates the fill for the FILL_IN bar of each priming sequence. MMMBar.
+    token_sequences = [
+        token_sequence if token_sequence.split()[-1] == "FILL_START" else token_sequence + " FILL_START"
+        for token_sequence in token_sequences
+    ]
+    return generate_batch(
+        model,
+        tokenizer,
+        token_sequences,
+        stop_tokens=["FILL_END"],
+        stop_tokens_count=1,
+        **kwargs
+    )
+
+
+def compose(
+    model,
+    tokenizer,
+    bars_number,
+    instruments=[0, 1, 2, 3],
+    densities=None,
+    priming_token_sequence=None,
+    window_size_bars=2,
+    context_bars=1,
+    max_new_tokens_per_track=256,
+    temperature=0.9,
+    use_grammar=True
+    ):
+
+    # Composes a song that is longer than the model context, window by window. Each track of a
+    # window is primed with the last context_bars bars of the same track. Yields each completed
+    # bar as a tuple of the bar index and the bar tokens for all tracks, as soon as it is done.
+    # Each prompt mostly starts with the previous prompt and what was kept of its output. The key
+    # value cache of that common prefix is reused. Tokens are compared position by position, so
+    # the reuse ends where a new window's context starts or where tracks were dropped from the front.
+    assert 0 <= context_bars < window_size_bars
+    vocabulary = tokenizer.get_vocab()
+    track_end_token_ids = [vocabulary[token] for token in ["TRACK_END", "PIECE_END"] if token in vocabulary]
+    n_ctx = getattr(model.config, "n_ctx", model.config.n_positions)
+    max_prompt_length = n_ctx - max_new_tokens_per_track
+    assert max_prompt_length > 0
+
+    def encode(tokens):
+        return [vocabulary[token] for token in tokens]
+
+    # The cache and the token ids it covers. Only transformers models take a cache. Exported
+    # TorchScript models always run the full prompt.
+    reuse_cache = isinstance(model, PreTrainedModel)
+    cache, cache_ids = None, []
+
+    # The bars of all tracks. Start with the priming sequence if there is one.
+    # Its tracks are matched to the instruments. Their densities are used if none are given.
+    tracks_bars = [[] for _ in instruments]
+    if priming_token_sequence is not None:
+        priming_tracks = {track["instrument"]: track for track in get_tracks_from_token_sequence(priming_token_sequence)}
+        assert sorted(priming_tracks.keys()) == sorted(str(instrument) for instrument in instruments), "The priming sequence must have one track per instrument."
+        priming_tracks = [priming_tracks[str(instrument)] for instrument in instruments]
+        if densities is None:
+            densities = [priming_track["density"] for priming_track in priming_tracks]
+        for track_bars, priming_track in zip(tracks_bars, priming_tracks):
+            track_bars += priming_track["bars"]
+        priming_bars_number = min(len(track_bars) for track_bars in tracks_bars)
+        for bar_index in range(priming_bars_number):
+            yield bar_index, [track_bars[bar_index] for track_bars in tracks_bars]
+        tracks_bars = [track_bars[:priming_bars_number] for track_bars in tracks_bars]
+
+    if densities is None:
+        densities = [2] * len(instruments)
+
+    # Generate window by window.
+    while len(tracks_bars[0]) < bars_number:
+        bar_start_index = len(tracks_bars[0])
+        window_context_bars = min(context_bars, bar_start_index)
+        new_bars_number = window_size_bars - window_context_bars
+
+        # The prompt consists of segments. Whole tracks are dropped from the start if it gets too long.
+        segments = []
+        for track_index, instrument in enumerate(instruments):
+            context = tracks_bars[track_index][bar_start_index - window_context_bars:bar_start_index]
+            prefix_tokens = ["TRACK_START", f"INST={instrument}", f"DENSITY={densities[track_index]}"]
+            prefix_tokens += [token for bar in context for token in bar]
+            prefix_ids = encode(prefix_tokens)
+            while len(segments) > 0 and 1 + sum(len(segment) for segment in segments) + len(prefix_ids) > max_prompt_length:
+                segments = segments[1:]
+            input_ids = encode(["PIECE_START"]) + [token_id for segment in segments for token_id in segment] + prefix_ids
+            assert len(input_ids) <= max_prompt_length, "The context does not fit into the model."
+
+            # Reuse the cache for the common prefix. The last prompt token is always run, for its logits.
+            generate_kwargs = {}
+            if use_grammar:
+                generate_kwargs["logits_processor"] = LogitsProcessorList([MMMGrammarLogitsProcessor(vocabulary, eos_token_ids=track_end_token_ids)])
+            if reuse_cache:
+                common_length = 0
+                while common_length < min(len(cache_ids), len(input_ids) - 1) and cache_ids[common_length] == input_ids[common_length]:
+                    common_length += 1
+                if common_length != 0:
+                    if common_length < cache.get_seq_length():
+                        cache.crop(common_length - cache.get_seq_length())
+                    generate_kwargs["past_key_values"] = cache
+                generate_kwargs["return_dict_in_generate"] = True
+
+            # Generate the rest of the track.
+            with torch.no_grad():
+                outputs = model.generate(
+                    torch.tensor([input_ids], dtype=torch.long),
+                    max_new_tokens=max_new_tokens_per_track,
+                    do_sample=True,
+                    temperature=temperature,
+                    eos_token_id=track_end_token_ids,
+                    pad_token_id=tokenizer.pad_token_id,
+                    use_cache=True,
+                    **generate_kwargs
+                )
+            if reuse_cache:
+                output_ids = outputs.sequences
+                cache = outputs.past_key_values
+                cache_ids = output_ids[0, :cache.get_seq_length()].tolist()
+            else:
+                output_ids = outputs
+            new_ids = output_ids[0, len(input_ids):].tolist()
+            new_tokens = [token for token in tokenizer.convert_ids_to_tokens(new_ids) if token != "[PAD]"]
+
+            # Keep exactly the new bars. Missing bars are empty.
+            new_bars = get_bars_from_tokens(new_tokens)[:new_bars_number]
+            new_bars += [["BAR_START", "BAR_END"]] * (new_bars_number - len(new_bars))
+            tracks_bars[track_index] += new_bars
+            segments += [prefix_ids + encode([token for bar in new_bars for token in bar] + ["TRACK_END"])]
+
+        # Yield the completed bars.
+        for bar_index in range(bar_start_index, min(bar_start_index + new_bars_number, bars_number)):
+            yield bar_index, [track_bars[bar_index] for track_bars in tracks_bars]
+
+
+def bars_to_token_sequence(tracks_bars, instruments, densities=None):
+
+    # Turns the bars of all tracks into a single piece. For example from the bars yielded by compose.
+    if densities is None:
+        densities = [2] * len(instruments)
+    tokens = ["PIECE_START"]
+    for track_bars, instrument, density in zip(tracks_bars, instruments, densities):
+        tokens += ["TRACK_START", f"INST={instrument}", f"DENSITY={density}"]
+        tokens += [token for bar in track_bars for token in bar]
+        tokens += ["TRACK_END"]
+    return " ".join(tokens)
+
+
+def get_tracks_from_token_sequence(token_sequence):
+    if isinstance(token_sequence, str):
+        token_sequence = token_sequence.split()
+
+    tracks = []
+    for token in token_sequence:
+        if token == "TRACK_START":
+            tracks += [{"instrument": None, "density": None, "tokens": []}]
+        elif token == "TRACK_END" or len(tracks) == 0:
+            pass
+        elif token.startswith("INST="):
+            tracks[-1]["instrument"] = token.split("=")[-1]
+        elif token.startswith("DENSITY="):
+            tracks[-1]["density"] = token.split("=")[-1]
+        else:
+            tracks[-1]["tokens"] += [token]
+    for track in tracks:
+        track["bars"] = get_bars_from_tokens(track["tokens"])
+    return tracks
+
+
+def get_bars_from_tokens(tokens):
+    bars = []
+    bar = None
+    for token in tokens:
+        if token == "BAR_START":
+            bar = ["BAR_START"]
+        elif token == "BAR_END" and bar is not None:
+            bars += [bar + ["BAR_END"]]
+            bar = None
+        elif bar is not None:
+            bar += [token]
+    return bars
+
+
+class StopTokensCountCriteria(StoppingCriteria):
+
+    # Stops each sequence once it has generated a number of stop tokens.
+    def __init__(self, stop_token_ids, count, prompt_length):
+        self.stop_token_ids = torch.tensor(stop_token_ids, dtype=torch.long)
+        self.count = count
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated_ids = input_ids[:, self.prompt_length:]
+        stop_token_ids = self.stop_token_ids.to(input_ids.device)
+        found = torch.isin(generated_ids, stop_token_ids).sum(dim=1)
+        return found >= self.count
+
+
 def token_sequence_to_note_sequence(token_sequence, use_program=True, use_drums=True):
 
     if isinstance(token_sequence, str):
@@ -168,3 +500,12 @@ def token_sequence_to_note_sequence(token_sequence, use_program=True, use_drums=
             assert False, token
 
     return note_sequence
+
+
+def token_sequences_to_note_sequences(token_sequences, use_program=True, use_drums=True, token_table=None, skip_invalid=False):
+
+    # The same notes as token_sequence_to_note_sequence, for many token sequences at once.
+    # With a token table from notetablehelpers.create_token_table, the token sequences can be token ids.
+    # With skip_invalid, token sequences that cannot be decoded give None.
+    note_tables = token_sequences_to_note_tables(token_sequences, use_program=use_program, use_drums=use_drums, token_table=token_table, skip_invalid=skip_invalid)
+    return [note_table_to_note_sequence(note_table) if note_table is not None else None for note_table in note_tables]
@@ -0,0 +1,100 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+import os
+import numpy as np
+
+# Token ids are stored as a flat uint16 array in a .bin file. The sequence boundaries are
+# stored next to it as an int64 offsets array with one more entry than there are sequences.
+TOKEN_IDS_DTYPE = np.uint16
+TOKEN_IDS_MAXIMUM = np.iinfo(TOKEN_IDS_DTYPE).max
+TOKEN_IDS_BUFFER_SIZE = 1024 * 1024
+TOKEN_IDS_BATCH_SIZE = 1024
+
+
+def is_token_ids_path(path):
+    return path.endswith(".bin")
+
+
+def get_token_ids_offsets_path(path):
+    assert is_token_ids_path(path), path
+    return path[:-len(".bin")] + "_offsets.npy"
+
+
+class TokenIdsWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb", buffering=TOKEN_IDS_BUFFER_SIZE)
+        self.offsets = [0]
+
+    def write(self, token_ids):
+        token_ids = np.asarray(token_ids)
+        if len(token_ids) != 0 and (token_ids.min() < 0 or token_ids.max() > TOKEN_IDS_MAXIMUM):
+            raise Exception(f"Token ids must be in [0, {TOKEN_IDS_MAXIMUM}].")
+        self.file.write(token_ids.astype(TOKEN_IDS_DTYPE).tobytes())
+        self.offsets += [self.offsets[-1] + len(token_ids)]
+
+    def close(self):
+        self.file.close()
+        np.save(get_token_ids_offsets_path(self.path), np.array(self.offsets, dtype=np.int64))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_token_ids(path, mmap=True):
+
+    # Returns the flat token ids and the offsets. Sequence i is token_ids[offsets[i]:offsets[i + 1]].
+    offsets = np.load(get_token_ids_offsets_path(path))
+    if os.path.getsize(path) == 0:
+        token_ids = np.zeros((0,), dtype=TOKEN_IDS_DTYPE)
+    elif mmap:
+        token_ids = np.memmap(path, dtype=TOKEN_IDS_DTYPE, mode="r")
+    else:
+        token_ids = np.fromfile(path, dtype=TOKEN_IDS_DTYPE)
+    assert offsets[-1] == len(token_ids), f"Offsets do not match {path}."
+    return token_ids, offsets
+
+
+def save_token_ids_from_token_sequences(tokenizer, text_path, path, batch_size=TOKEN_IDS_BATCH_SIZE):
+
+    # The tokenizer is a tokenizers.Tokenizer. Lines are encoded in batches.
+    def encode_and_write(lines):
+        for encoding in tokenizer.encode_batch(lines):
+            writer.write(encoding.ids)
+
+    with open(text_path, "r") as file, TokenIdsWriter(path) as writer:
+        lines = []
+        for line in file:
+            lines += [line.strip()]
+            if len(lines) == batch_size:
+                encode_and_write(lines)
+                lines = []
+        encode_and_write(lines)
+
+
+def get_token_ids_cache_path(text_path):
+    return os.path.splitext(text_path)[0] + ".bin"
+
+
+def is_token_ids_cache_valid(text_path, path):
+    if not os.path.exists(path) or not os.path.exists(get_token_ids_offsets_path(path)):
+        return False
+    return os.path.getmtime(path) >= os.path.getmtime(text_path)
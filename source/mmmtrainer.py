@@ -28,6 +28,13 @@ from transformers import GPT2Config, GPT2LMHeadModel
 from transformers import PreTrainedTokenizerFast
 from tqdm import tqdm
 from source.mmmtrainerconfig import MMMTrainerBaseConfig
+from source.helpers.tokenidshelpers import (
+    is_token_ids_path,
+    load_token_ids,
+    get_token_ids_cache_path,
+    is_token_ids_cache_valid,
+    save_token_ids_from_token_sequences
+)
 from source import logging
 
 logger = logging.create_logger("mmmtrainer")
@@ -89,30 +96,35 @@ class MMMTrainer:
 
         # Prepare the training dataset.
         print("Preparing training dataset...")
-        dataset_train = TokenSequenceDataset(
+        dataset_train = self.__create_dataset(
             tokenizer=pretrained_tokenizer,
             dataset_paths=self.config.dataset_train_files,
-            block_size=self.config.pad_length,
             simulate=simulate
         )
         logger.info("Training dataset prepared.")
 
         # Prepare the validation dataset.
         print("Preparing validate dataset...")
-        dataset_valid = TokenSequenceDataset(
+        dataset_valid = self.__create_dataset(
             tokenizer=pretrained_tokenizer,
             dataset_paths=self.config.dataset_validate_files,
-            block_size=self.config.pad_length,
             simulate=simulate
         )
         logger.info("Validation dataset prepared.")
 
-        # Prepare data collator.
-        data_collator = DataCollatorWithPadding(
-            tokenizer=pretrained_tokenizer,
-            padding="max_length",
-            max_length=self.config.pad_length
-        )
+        # Prepare data collator. Dynamic padding only pads to the longest sequence in the batch.
+        if self.config.sequence_packing:
+            data_collator = PackedSequenceDataCollator()
+        elif self.config.dynamic_padding:
+            data_collator = DynamicPaddingDataCollator(
+                pad_token_id=tokenizer.token_to_id("[PAD]")
+            )
+        else:
+            data_collator = DataCollatorWithPadding(
+                tokenizer=pretrained_tokenizer,
+                padding="max_length",
+                max_length=self.config.pad_length
+            )
 
         # Create the trainer.
         print("Creating trainer...")
@@ -128,7 +140,9 @@ class MMMTrainer:
             logging_strategy="steps",
             logging_dir=os.path.join(output_path, "logs"),
             load_best_model_at_end=True,
-            save_strategy="steps"
+            save_strategy="steps",
+            group_by_length=self.config.dynamic_padding,
+            remove_unused_columns=not self.config.sequence_packing
         )
         trainer = Trainer(
             model=model,
@@ -147,10 +161,67 @@ class MMMTrainer:
         trainer.save_model(model_path)
         logger.info(f"Model saved to {model_path}.")
 
+    def __create_dataset(self, tokenizer, dataset_paths, simulate):
+
+        # Packed datasets concatenate the sequences into blocks.
+        if self.config.sequence_packing:
+            return PackedTokenIdsDataset(
+                tokenizer=tokenizer,
+                dataset_paths=self.__get_token_ids_paths(tokenizer, dataset_paths),
+                block_size=self.config.pad_length,
+                simulate=simulate
+            )
+
+        # Memory mapped datasets need token ids.
+        if self.config.memory_mapped_dataset:
+            return MemoryMappedTokenIdsDataset(
+                tokenizer=tokenizer,
+                dataset_paths=self.__get_token_ids_paths(tokenizer, dataset_paths),
+                block_size=self.config.pad_length,
+                simulate=simulate,
+                padding=not self.config.dynamic_padding
+            )
+
+        # Binary token ids files do not need tokenization.
+        if all(is_token_ids_path(dataset_path) for dataset_path in dataset_paths):
+            return TokenIdsDataset(
+                tokenizer=tokenizer,
+                dataset_paths=dataset_paths,
+                block_size=self.config.pad_length,
+                simulate=simulate,
+                padding=not self.config.dynamic_padding
+            )
+        elif any(is_token_ids_path(dataset_path) for dataset_path in dataset_paths):
+            raise Exception(f"Cannot mix token sequence and token ids files {dataset_paths}.")
+
+        return TokenSequenceDataset(
+            tokenizer=tokenizer,
+            dataset_paths=dataset_paths,
+            block_size=self.config.pad_length,
+            simulate=simulate,
+            batch_size=self.config.tokenization_batch_size,
+            padding=not self.config.dynamic_padding
+        )
+
+
+    def __get_token_ids_paths(self, tokenizer, dataset_paths):
+
+        # Tokenize text files once and reuse the result.
+        token_ids_paths = []
+        for dataset_path in dataset_paths:
+            if not is_token_ids_path(dataset_path):
+                token_ids_path = get_token_ids_cache_path(dataset_path)
+                if not is_token_ids_cache_valid(dataset_path, token_ids_path):
+                    logger.info(f"Tokenizing {dataset_path} to {token_ids_path}...")
+                    save_token_ids_from_token_sequences(tokenizer.backend_tokenizer, dataset_path, token_ids_path)
+                dataset_path = token_ids_path
+            token_ids_paths += [dataset_path]
+        return token_ids_paths
+
 
 class TokenSequenceDataset(Dataset):
 
-    def __init__(self, tokenizer, dataset_paths, block_size, simulate=False):
+    def __init__(self, tokenizer, dataset_paths, block_size, simulate=False, batch_size=1024, padding=True):
 
         pad_token_id = tokenizer.encode("[PAD]")[0]
         unk_token_id = tokenizer.encode("[UNK]")[0]
@@ -174,15 +245,14 @@ class TokenSequenceDataset(Dataset):
         unknown_token_lines_count = 0
         too_long_lines_count = 0
         encoded_lengths = []
-        for line in tqdm(lines):
+        for line, encoded_line in tqdm(zip(lines, self.__encode_lines(tokenizer, lines, batch_size)), total=len(lines)):
 
             #Skip empty lines.
             line = line.strip()
             if line == "":
                 continue
 
-            # Encode the line.
-            encoded_line = tokenizer.encode(line)
+            # The line has been encoded in a batch.
             encoded_lengths += [len(encoded_line)]
             tokens_count += len(encoded_line)
 
@@ -204,10 +274,15 @@ class TokenSequenceDataset(Dataset):
                 too_long_lines_count += 1
                 continue
 
+            # Keep the line as is. The data collator will pad.
+            if not padding:
+                tensor = np.array(encoded_line, dtype=np.long)
+
             # Pad and truncate.
-            tensor = np.full((block_size,), pad_token_id, dtype=np.long)
-            tensor[:len(encoded_line)] = encoded_line
-            assert len(tensor) == block_size
+            else:
+                tensor = np.full((block_size,), pad_token_id, dtype=np.long)
+                tensor[:len(encoded_line)] = encoded_line
+                assert len(tensor) == block_size
 
             self.examples += [{
                 "input_ids": torch.tensor(tensor, dtype=torch.long),
@@ -225,8 +300,309 @@ class TokenSequenceDataset(Dataset):
         logger.info(f"Lines with unknown tokens {unknown_token_lines_count}/{len(lines)}, {100 * unknown_token_lines_count / len(lines):.2f}%.")
         logger.info(f"Too long lines {too_long_lines_count}/{len(lines)}, {100 * too_long_lines_count / len(lines):.2f}%.")
 
+    def __encode_lines(self, tokenizer, lines, batch_size):
+
+        # Encode batches of lines. This uses the parallelism of the tokenizers backend.
+        # Yields None for empty lines in order to keep the lines and the encodings aligned.
+        for batch_start in range(0, len(lines), batch_size):
+            batch_lines = [line.strip() for line in lines[batch_start:batch_start + batch_size]]
+            batch_lines_not_empty = [line for line in batch_lines if line != ""]
+            encoded_lines = iter(tokenizer(batch_lines_not_empty)["input_ids"] if batch_lines_not_empty else [])
+            for line in batch_lines:
+                yield next(encoded_lines) if line != "" else None
+
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, i) -> Dict[str, torch.tensor]:
         return self.examples[i]
+
+
+class TokenIdsDataset(Dataset):
+
+    def __init__(self, tokenizer, dataset_paths, block_size, simulate=False, padding=True):
+
+        pad_token_id = tokenizer.encode("[PAD]")[0]
+        unk_token_id = tokenizer.encode("[UNK]")[0]
+
+        # Read all sequences from all files. These have been tokenized by the dataset creator.
+        encoded_lines = []
+        for dataset_path in dataset_paths:
+            assert os.path.isfile(dataset_path), f"Input file path {dataset_path} not found"
+            token_ids, offsets = load_token_ids(dataset_path, mmap=False)
+            encoded_lines += np.split(token_ids, offsets[1:-1])
+
+        # In simulation just use a few samples.
+        if simulate:
+            random.shuffle(encoded_lines)
+            encoded_lines = encoded_lines[:10]
+
+        # Turn sequences into training examples. Also gather some statistics.
+        self.examples = []
+        tokens_count = 0
+        unknown_token_lines_count = 0
+        too_long_lines_count = 0
+        encoded_lengths = []
+        for encoded_line in tqdm(encoded_lines):
+
+            # Skip empty lines.
+            if len(encoded_line) == 0:
+                continue
+
+            encoded_lengths += [len(encoded_line)]
+            tokens_count += len(encoded_line)
+
+            # Skip lines with unknown tokens.
+            if unk_token_id in encoded_line:
+                unknown_token_lines_count += 1
+                continue
+
+            # Skip sequence if it is too long.
+            if len(encoded_line) > block_size:
+                too_long_lines_count += 1
+                continue
+
+            # Keep the sequence as is. The data collator will pad.
+            if not padding:
+                tensor = encoded_line.astype(np.int64)
+
+            # Pad and truncate.
+            else:
+                tensor = np.full((block_size,), pad_token_id, dtype=np.int64)
+                tensor[:len(encoded_line)] = encoded_line
+                assert len(tensor) == block_size
+
+            self.examples += [{
+                "input_ids": torch.tensor(tensor, dtype=torch.long),
+                "labels": torch.tensor(tensor, dtype=torch.long)
+            }]
+
+        # A little statistics at the end.
+        logger.info(f"Minimum sequence length before padding: {np.min(encoded_lengths)}")
+        logger.info(f"Mean sequence length before padding:    {np.mean(encoded_lengths)}")
+        logger.info(f"STD sequence length before padding:     {np.std(encoded_lengths)}")
+        logger.info(f"Maximum sequence length before padding: {np.max(encoded_lengths)}")
+        logger.info(f"Number of tokens: {tokens_count}")
+        logger.info(f"Lines with unknown tokens {unknown_token_lines_count}/{len(encoded_lines)}, {100 * unknown_token_lines_count / len(encoded_lines):.2f}%.")
+        logger.info(f"Too long lines {too_long_lines_count}/{len(encoded_lines)}, {100 * too_long_lines_count / len(encoded_lines):.2f}%.")
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i) -> Dict[str, torch.tensor]:
+        return self.examples[i]
+
+
+class MemoryMappedTokenIdsDataset(Dataset):
+
+    # Keeps the token ids memory mapped. Examples are created on access.
+    def __init__(self, tokenizer, dataset_paths, block_size, simulate=False, padding=True, chunk_size=1 << 24, skip_too_long=True):
+
+        self.pad_token_id = tokenizer.encode("[PAD]")[0]
+        unk_token_id = tokenizer.encode("[UNK]")[0]
+        self.dataset_paths = dataset_paths
+        self.block_size = block_size
+        self.padding = padding
+
+        # Find the sequences to use. Memory maps are opened lazily in each process.
+        self.token_ids = None
+        self.indices = []
+        encoded_lengths = []
+        tokens_count = 0
+        lines_count = 0
+        unknown_token_lines_count = 0
+        too_long_lines_count = 0
+        for file_index, dataset_path in enumerate(dataset_paths):
+            assert os.path.isfile(dataset_path), f"Input file path {dataset_path} not found"
+            token_ids, offsets = load_token_ids(dataset_path)
+            lengths = np.diff(offsets)
+            lines_count += len(lengths)
+
+            # Find the sequences with unknown tokens. Go through the file in chunks.
+            has_unknown_token = np.zeros((len(lengths),), dtype=bool)
+            for chunk_start in range(0, len(token_ids), chunk_size):
+                positions = chunk_start + np.flatnonzero(token_ids[chunk_start:chunk_start + chunk_size] == unk_token_id)
+                has_unknown_token[np.searchsorted(offsets, positions, side="right") - 1] = True
+
+            # Skip empty lines, lines with unknown tokens and lines that are too long.
+            is_empty = lengths == 0
+            is_too_long = ~is_empty & ~has_unknown_token & (lengths > block_size)
+            is_valid = ~is_empty & ~has_unknown_token
+            if skip_too_long:
+                is_valid &= ~is_too_long
+            encoded_lengths += [lengths[~is_empty]]
+            tokens_count += int(lengths.sum())
+            unknown_token_lines_count += int(np.count_nonzero(has_unknown_token))
+            too_long_lines_count += int(np.count_nonzero(is_too_long))
+
+            # Store file index, start and end for each sequence.
+            valid_indices = np.flatnonzero(is_valid)
+            self.indices += [np.stack([
+                np.full((len(valid_indices),), file_index, dtype=np.int64),
+                offsets[valid_indices],
+                offsets[valid_indices + 1]
+            ], axis=1)]
+        self.indices = np.concatenate(self.indices, axis=0)
+        encoded_lengths = np.concatenate(encoded_lengths)
+
+        # In simulation just use a few samples.
+        if simulate:
+            self.indices = self.indices[np.random.permutation(len(self.indices))[:10]]
+
+        # A little statistics at the end.
+        logger.info(f"Minimum sequence length before padding: {np.min(encoded_lengths)}")
+        logger.info(f"Mean sequence length before padding:    {np.mean(encoded_lengths)}")
+        logger.info(f"STD sequence length before padding:     {np.std(encoded_lengths)}")
+        logger.info(f"Maximum sequence length before padding: {np.max(encoded_lengths)}")
+        logger.info(f"Number of tokens: {tokens_count}")
+        logger.info(f"Lines with unknown tokens {unknown_token_lines_count}/{lines_count}, {100 * unknown_token_lines_count / lines_count:.2f}%.")
+        if skip_too_long:
+            logger.info(f"Too long lines {too_long_lines_count}/{lines_count}, {100 * too_long_lines_count / lines_count:.2f}%.")
+
+    def __getstate__(self):
+
+        # Do not pickle the memory maps. DataLoader workers open their own.
+        state = self.__dict__.copy()
+        state["token_ids"] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i) -> Dict[str, torch.tensor]:
+        if self.token_ids is None:
+            self.token_ids = [load_token_ids(dataset_path)[0] for dataset_path in self.dataset_paths]
+
+        # Pad if necessary. Labels and input ids share the same tensor.
+        file_index, start, end = self.indices[i]
+        tensor = torch.from_numpy(self.token_ids[file_index][start:end].astype(np.int64))
+        if self.padding:
+            tensor = torch.cat([tensor, torch.full((self.block_size - len(tensor),), self.pad_token_id, dtype=torch.long)])
+        return {
+            "input_ids": tensor,
+            "labels": tensor
+        }
+
+
+class DynamicPaddingDataCollator:
+
+    # Pads a batch to its longest sequence. Pad positions are masked out of the attention and the loss.
+    def __init__(self, pad_token_id, pad_to_multiple_of=None, label_pad_token_id=-100):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.label_pad_token_id = label_pad_token_id
+
+    def __call__(self, examples):
+
+        # Get the length to pad to.
+        lengths = [len(example["input_ids"]) for example in examples]
+        max_length = max(lengths)
+        if self.pad_to_multiple_of is not None:
+            max_length = ((max_length + self.pad_to_multiple_of - 1) // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        # Pad everything.
+        input_ids = torch.full((len(examples), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(examples), max_length), dtype=torch.long)
+        labels = torch.full((len(examples), max_length), self.label_pad_token_id, dtype=torch.long)
+        for example_index, (example, length) in enumerate(zip(examples, lengths)):
+            input_ids[example_index, :length] = torch.as_tensor(example["input_ids"])
+            attention_mask[example_index, :length] = 1
+            labels[example_index, :length] = torch.as_tensor(example["labels"])[:length]
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels
+        }
+
+
+class PackedTokenIdsDataset(MemoryMappedTokenIdsDataset):
+
+    # Concatenates the sequences and cuts them into blocks. Each example comes with position ids
+    # that restart at every sequence and with segment ids that tell the sequences apart.
+    # Sequences longer than a block are split into pieces of at most one block. None is skipped.
+    def __init__(self, tokenizer, dataset_paths, block_size, simulate=False, chunk_size=1 << 24):
+        super().__init__(tokenizer, dataset_paths, block_size, simulate=simulate, padding=False, chunk_size=chunk_size, skip_too_long=False)
+
+        # Split the too long sequences. Each piece is a sequence of its own.
+        pieces_counts = (self.indices[:, 2] - self.indices[:, 1] + block_size - 1) // block_size
+        too_long_count = int(np.count_nonzero(pieces_counts > 1))
+        if too_long_count != 0:
+            indices = np.repeat(self.indices, pieces_counts, axis=0)
+            piece_indices = np.arange(len(indices)) - np.repeat(np.cumsum(pieces_counts) - pieces_counts, pieces_counts)
+            indices[:, 1] += piece_indices * block_size
+            indices[:, 2] = np.minimum(indices[:, 2], indices[:, 1] + block_size)
+            logger.info(f"Split {too_long_count} too long sequences into {int(pieces_counts[pieces_counts > 1].sum())} pieces.")
+            self.indices = indices
+
+        # Where each sequence starts in the concatenation.
+        lengths = self.indices[:, 2] - self.indices[:, 1]
+        self.packed_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        logger.info(f"Packed {len(self.indices)} sequences into {len(self)} blocks of {block_size} tokens.")
+
+    def __len__(self):
+        return int((self.packed_offsets[-1] + self.block_size - 1) // self.block_size)
+
+    def __getitem__(self, i) -> Dict[str, torch.tensor]:
+        if self.token_ids is None:
+            self.token_ids = [load_token_ids(dataset_path)[0] for dataset_path in self.dataset_paths]
+
+        # Start with padding. Segment id -1 marks padding.
+        input_ids = torch.full((self.block_size,), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((self.block_size,), -100, dtype=torch.long)
+        position_ids = torch.zeros((self.block_size,), dtype=torch.long)
+        segment_ids = torch.full((self.block_size,), -1, dtype=torch.long)
+
+        # Copy the pieces of all sequences that overlap the block.
+        block_start = i * self.block_size
+        block_end = min(block_start + self.block_size, self.packed_offsets[-1])
+        sequence_index = np.searchsorted(self.packed_offsets, block_start, side="right") - 1
+        while block_start < block_end:
+            file_index, start, end = self.indices[sequence_index]
+            piece_start = block_start - self.packed_offsets[sequence_index]
+            piece_end = min(end - start, block_end - self.packed_offsets[sequence_index])
+            piece = torch.from_numpy(self.token_ids[file_index][start + piece_start:start + piece_end].astype(np.int64))
+            position = block_start - i * self.block_size
+            input_ids[position:position + len(piece)] = piece
+            labels[position:position + len(piece)] = piece
+            position_ids[position:position + len(piece)] = torch.arange(piece_start, piece_end)
+            segment_ids[position:position + len(piece)] = sequence_index
+
+            # Do not predict the start of a sequence from the end of the previous one.
+            if piece_start == 0:
+                labels[position] = -100
+
+            block_start += len(piece)
+            sequence_index += 1
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "segment_ids": segment_ids
+        }
+
+
+class PackedSequenceDataCollator:
+
+    # Turns the segment ids into a causal 4D attention mask that keeps the sequences apart.
+    def __call__(self, examples):
+        input_ids = torch.stack([example["input_ids"] for example in examples])
+        labels = torch.stack([example["labels"] for example in examples])
+        position_ids = torch.stack([example["position_ids"] for example in examples])
+        segment_ids = torch.stack([example["segment_ids"] for example in examples])
+
+        # Attend to earlier tokens of the same sequence. Padding only attends to itself.
+        length = input_ids.shape[1]
+        causal = torch.tril(torch.ones((length, length), dtype=torch.bool))
+        same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+        allowed = (same_segment & causal[None]) | torch.eye(length, dtype=torch.bool)[None]
+        attention_mask = torch.zeros(allowed.shape, dtype=torch.float)
+        attention_mask.masked_fill_(~allowed, torch.finfo(torch.float).min)
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask[:, None],
+            "labels": labels,
+            "position_ids": position_ids
+        }
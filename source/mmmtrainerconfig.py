@@ -35,7 +35,11 @@ class MMMTrainerBaseConfig:
         n_layer=6,
         n_embd=512,
         n_positions=1024,
-        n_ctx=1024
+        n_ctx=1024,
+        memory_mapped_dataset=False,
+        tokenization_batch_size=1024,
+        dynamic_padding=False,
+        sequence_packing=False
         ):
 
         # Check if the framework is valid.
@@ -55,6 +59,31 @@ class MMMTrainerBaseConfig:
 
         assert pad_length <= n_positions
 
+        if not isinstance(memory_mapped_dataset, bool):
+            error_string = f"Config parameter memory_mapped_dataset must be a boolean, but is {memory_mapped_dataset}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if not isinstance(tokenization_batch_size, int) or tokenization_batch_size < 1:
+            error_string = f"Config parameter tokenization_batch_size must be a positive integer, but is {tokenization_batch_size}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if not isinstance(dynamic_padding, bool):
+            error_string = f"Config parameter dynamic_padding must be a boolean, but is {dynamic_padding}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if not isinstance(sequence_packing, bool):
+            error_string = f"Config parameter sequence_packing must be a boolean, but is {sequence_packing}."
+            logger.error(error_string)
+            raise Exception(error_string)
+
+        if sequence_packing and dynamic_padding:
+            error_string = f"Config parameters sequence_packing and dynamic_padding cannot be used together."
+            logger.error(error_string)
+            raise Exception(error_string)
+
         self.framework = framework
         self.tokenizer_path = tokenizer_path
         self.dataset_train_files = dataset_train_files
@@ -68,6 +97,10 @@ class MMMTrainerBaseConfig:
         self.n_embd = n_embd
         self.n_positions = n_positions
         self.n_ctx = n_ctx
+        self.memory_mapped_dataset = memory_mapped_dataset
+        self.tokenization_batch_size = tokenization_batch_size
+        self.dynamic_padding = dynamic_padding
+        self.sequence_packing = sequence_packing
 
 
 class JSBTrackConfig(MMMTrainerBaseConfig):
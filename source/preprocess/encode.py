@@ -14,29 +14,44 @@
 
 # Lint as: python3
 
-import itertools
 import numpy as np
 import random
 import json
+from source.preprocess.preprocessutilities import (
+    EVENT_TIME_DELTA,
+    EVENT_TYPES,
+    song_data_to_compact
+)
 
+# The structural tokens of the encoding in vocabulary order. The fill tokens only with bar fill.
+STRUCTURE_TOKENS = ["PIECE_START", "TRACK_START", "TRACK_END", "BAR_START", "BAR_END"]
+FILL_TOKENS = ["FILL_START", "FILL_IN", "FILL_END"]
 
-def encode_songs_data(songs_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill):
+
+def encode_songs_data(songs_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill, return_metadata=False):
 
     # This will be returned.
     token_sequences = []
 
     # Go through all songs.
     for song_data in songs_data:
-        token_sequences += encode_song_data(song_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill)
+        token_sequences += encode_song_data(song_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill, return_metadata)
 
     # Done.
     return token_sequences
 
 
-def encode_song_data(song_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill):
+def encode_songs_data_stream(songs_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill, return_metadata=False):
 
-    # This will be returned.
-    token_sequences = []
+    # Same as encode_songs_data. But yields the token sequences one by one instead of collecting them.
+    for song_data in songs_data:
+        yield from encode_song_data(song_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill, return_metadata)
+
+
+def encode_song_data(song_data, transpositions, permute, window_size_bars, hop_length_bars, density_bins, bar_fill, return_metadata=False):
+
+    # With return_metadata, yields pairs of token sequence and metadata. The metadata has the song,
+    # the bar window, the transposition, the order of the tracks and their densities.
 
     # Count the bars.
     bars = get_bars_number(song_data)
@@ -44,48 +59,129 @@ def encode_song_data(song_data, transpositions, permute, window_size_bars, hop_l
     # For iterating over the bars.
     bar_indices = get_bar_indices(bars, window_size_bars, hop_length_bars)
 
+    # The densities of all tracks in all windows at once. Bar fill takes bars out of the count
+    # while encoding, so there they are determined for each token sequence.
+    note_on_counts = get_note_on_counts(song_data)
+    if not bar_fill:
+        windows_densities = np.digitize(get_window_note_on_counts(note_on_counts, bar_indices), density_bins)
+
     # Go through all combinations.
     count = 0
-    for (bar_start_index, bar_end_index), transposition in itertools.product(bar_indices, transpositions):
-
-        # Start empty
-        token_sequence = []
-
-        # Do bar fill if necessary.
-        if bar_fill:
-            track_data = random.choice(song_data["tracks"])
-            bar_data = random.choice(track_data["bars"][bar_start_index:bar_end_index])
-            bar_data_fill = {"events": bar_data["events"]}
-            bar_data["events"] = "bar_fill"
-
-        # Start with the tokens.
-        token_sequence += ["PIECE_START"]
-
-        # Get the indices. Permute if necessary.
-        track_data_indices = list(range(len(song_data["tracks"])))
-        if permute:
-            random.shuffle(track_data_indices)
+    for window_index, (bar_start_index, bar_end_index) in enumerate(bar_indices):
+
+        # Without bar fill all transpositions share the same structure. Encode the tracks once.
+        if not bar_fill:
+            densities = windows_densities[:, window_index].tolist()
+            encoded_tracks_data_transposed = [
+                encode_track_data_transposed(track_data, density_bins, bar_start_index, bar_end_index, transpositions, density=density)
+                for track_data, density in zip(song_data["tracks"], densities)
+            ]
+
+        for transposition_index, transposition in enumerate(transpositions):
+
+            # Start empty
+            token_sequence = []
+
+            # Do bar fill if necessary. The bar does not count for the density anymore.
+            if bar_fill:
+                track_data_fill = random.choice(song_data["tracks"])
+                bar_data = random.choice(track_data_fill["bars"][bar_start_index:bar_end_index])
+                bar_data_fill = {"events": bar_data["events"]}
+                bar_data["events"] = "bar_fill"
+                fill_track_index = next(index for index, track_data in enumerate(song_data["tracks"]) if track_data is track_data_fill)
+                fill_bar_index = next(index for index, bar in enumerate(track_data_fill["bars"]) if bar is bar_data)
+                note_on_counts[fill_track_index, fill_bar_index] = 0
+                densities = np.digitize(note_on_counts[:, bar_start_index:bar_end_index].sum(axis=1), density_bins).tolist()
+
+            # Start with the tokens.
+            token_sequence += ["PIECE_START"]
+
+            # Get the indices. Permute if necessary.
+            track_data_indices = list(range(len(song_data["tracks"])))
+            if permute:
+                random.shuffle(track_data_indices)
+
+            # Encode the tracks.
+            for track_data_index in track_data_indices:
+
+                # Use the pre-transposed track.
+                if not bar_fill:
+                    token_sequence += encoded_tracks_data_transposed[track_data_index][transposition_index]
+                    continue
+
+                track_data = song_data["tracks"][track_data_index]
+
+                # Encode the track. Insert density tokens. Also transpose.
+                encoded_track_data = encode_track_data(track_data, density_bins, bar_start_index, bar_end_index, transposition, density=densities[track_data_index])
+                token_sequence += encoded_track_data
+
+            # Encode the fill tokens.
+            if bar_fill:
+                token_sequence += encode_bar_data(bar_data_fill, transposition, bar_fill=True)
+
+            if not return_metadata:
+                yield token_sequence
+            else:
+                metadata = {
+                    "song_number": song_data["number"],
+                    "song_title": song_data["title"],
+                    "bar_start_index": bar_start_index,
+                    "bar_end_index": bar_end_index,
+                    "transposition": transposition,
+                    "track_indices": track_data_indices,
+                    "instruments": [get_instrument(song_data["tracks"][track_data_index]) for track_data_index in track_data_indices],
+                    "densities": [densities[track_data_index] for track_data_index in track_data_indices]
+                }
+                if bar_fill:
+                    metadata["fill_track_index"] = fill_track_index
+                    metadata["fill_bar_index"] = fill_bar_index
+                yield token_sequence, metadata
+            count += 1
+
+
+def encode_track_data_transposed(track_data, density_bins, bar_start_index, bar_end_index, transpositions, density=None):
+
+    # Encode without transposition. Drums are never transposed, so this is the result for all of them.
+    tokens = encode_track_data(track_data, density_bins, bar_start_index, bar_end_index, 0, density=density)
+    if track_data.get("drums", False):
+        return [tokens] * len(transpositions)
+
+    # Find the pitch tokens. They follow TRACK_START, INST, DENSITY and each BAR_START.
+    slot_indices = []
+    slot_types = []
+    slot_pitches = []
+    token_index = 3
+    for bar_data in track_data["bars"][bar_start_index:bar_end_index]:
+        token_index += 1
+        bar_events = bar_data["events"]
+        is_pitch = bar_events.types != EVENT_TIME_DELTA
+        slot_indices += (token_index + np.flatnonzero(is_pitch)).tolist()
+        slot_types += bar_events.types[is_pitch].tolist()
+        slot_pitches += bar_events.values[is_pitch].astype(np.int64).tolist()
+        token_index += len(bar_events) + 1
+    assert token_index + 1 == len(tokens)
 
-        # Encode the tracks.
-        for track_data_index in track_data_indices:
-            track_data = song_data["tracks"][track_data_index]
+    # Transpose all pitches at once and render the pitch tokens.
+    slot_prefixes = np.array([EVENT_TYPES[slot_type] + "=" for slot_type in slot_types], dtype=str)
+    slot_pitches = np.array(slot_pitches, dtype=np.int64)[None, :] + np.array(transpositions, dtype=np.int64)[:, None]
+    slot_tokens = np.char.add(slot_prefixes[None, :], slot_pitches.astype(str))
 
-            # Encode the track. Insert density tokens. Also transpose.
-            encoded_track_data = encode_track_data(track_data, density_bins, bar_start_index, bar_end_index, transposition)
-            token_sequence += encoded_track_data
+    # Fill the slots of the template.
+    template = np.array(tokens, dtype=object)
+    tokens_transposed = []
+    for slot_tokens_transposition in slot_tokens:
+        template[slot_indices] = slot_tokens_transposition.tolist()
+        tokens_transposed += [template.tolist()]
+    return tokens_transposed
 
-        # Encode the fill tokens.
-        if bar_fill:
-            token_sequence += encode_bar_data(bar_data_fill, transposition, bar_fill=True)
 
-        token_sequences += [token_sequence]
-        count += 1
+def get_instrument(track_data):
 
-    # Done
-    return token_sequences
+    # The value of the INST token of a track.
+    return "DRUMS" if track_data.get("drums", False) else str(track_data["number"])
 
 
-def encode_track_data(track_data, density_bins, bar_start_index, bar_end_index, transposition):
+def encode_track_data(track_data, density_bins, bar_start_index, bar_end_index, transposition, density=None):
 
     tokens = []
 
@@ -103,17 +199,14 @@ def encode_track_data(track_data, density_bins, bar_start_index, bar_end_index,
         tokens += ["INST=DRUMS"]
         transposition = 0
 
-    # Count note on events.
-    note_on_events = 0
-    for bar_data in track_data["bars"][bar_start_index:bar_end_index]:
-        if bar_data["events"] == "bar_fill":
-            continue
-        for event_data in bar_data["events"]:
-            if event_data["type"] == "NOTE_ON":
-                note_on_events += 1
-
-    # Determine density.
-    density = np.digitize(note_on_events, density_bins)
+    # Count note on events and determine density. Unless the density is known already.
+    if density is None:
+        note_on_events = 0
+        for bar_data in track_data["bars"][bar_start_index:bar_end_index]:
+            if bar_data["events"] == "bar_fill":
+                continue
+            note_on_events += bar_data["events"].get_note_on_count()
+        density = np.digitize(note_on_events, density_bins)
     tokens += [f"DENSITY={density}"]
 
     # Encode the bars.
@@ -136,8 +229,7 @@ def encode_bar_data(bar_data, transposition, bar_fill=False):
     if bar_data["events"] == "bar_fill":
         tokens += ["FILL_IN"]
     else:
-        for event_data in bar_data["events"]:
-            tokens += [encode_event_data(event_data, transposition)]
+        tokens += encode_bar_events(bar_data["events"], transposition)
 
     if not bar_fill:
         tokens += ["BAR_END"]
@@ -147,77 +239,161 @@ def encode_bar_data(bar_data, transposition, bar_fill=False):
     return tokens
 
 
-def encode_event_data(event_data, transposition):
-    if event_data["type"] == "NOTE_ON":
-        return event_data["type"] + "=" + str(event_data["pitch"] + transposition)
-    elif event_data["type"] == "NOTE_OFF":
-        return event_data["type"] + "=" + str(event_data["pitch"] + transposition)
-    elif event_data["type"] == "TIME_DELTA":
-        return event_data["type"] + "=" + str(event_data["delta"])
+def encode_bar_events(bar_events, transposition):
+    tokens = []
+    for event_type, value in zip(bar_events.types.tolist(), bar_events.values.tolist()):
+        if event_type == EVENT_TIME_DELTA:
+            tokens += [EVENT_TYPES[event_type] + "=" + str(value)]
+        else:
+            tokens += [EVENT_TYPES[event_type] + "=" + str(int(value) + transposition)]
+    return tokens
 
 
-def get_density_bins(songs_data, window_size_bars, hop_length_bars, bins):
+def get_density_bins(songs_data, window_size_bars, hop_length_bars, bins, streaming=False):
 
-    # Go through all songs and count the note on events for each window.\
-    distribution = []
+    # Go through all songs and count the note on events for each window.
+    distribution = DensityDistribution(streaming)
     for song_data in songs_data:
-        # Count the bars.
-        bars = get_bars_number(song_data)
-
-        # Iterate over over the tracks and the bars.
-        bar_indices = get_bar_indices(bars, window_size_bars, hop_length_bars)
-        for track_data in song_data["tracks"]:
-            for bar_start_index, bar_end_index in bar_indices:
-
-                # Go through the bars and count notes.
-                count = 0
-                for bar in track_data["bars"][bar_start_index:bar_end_index]:
-                    count += len([event for event in bar["events"] if event["type"] == "NOTE_ON"])
-
-                # Do not count empty tracks.
-                if count != 0:
-                    distribution += [count]
+        bar_indices = get_bar_indices(get_bars_number(song_data), window_size_bars, hop_length_bars)
+        distribution.add(get_window_note_on_counts(get_note_on_counts(song_data), bar_indices))
 
     # Compute the quantiles, which will become the density bins.
-    quantiles = []
-    for i in range(100 // bins, 100, 100 // bins):
-        quantile = np.percentile(distribution, i)
-        quantiles += [quantile]
-    return quantiles
+    return distribution.get_quantiles(bins)
 
 
-def get_density_bins_from_json_files(json_paths, window_size_bars, hop_length_bars, bins):
+def get_density_bins_from_json_files(json_paths, window_size_bars, hop_length_bars, bins, streaming=False):
 
-    # Go through all songs and count the note on events for each window.\
-    distribution = []
+    # Go through all songs and count the note on events for each window.
+    distribution = DensityDistribution(streaming)
     for json_path in json_paths:
 
-        # Open the file and get the data.
+        # Open the file and get the data. Skip songs that have been cached as skipped.
         song_data = json.load(open(json_path, "r"))
+        if song_data is None:
+            continue
+        song_data = song_data_to_compact(song_data)
 
-        # Count the bars.
-        bars = get_bars_number(song_data)
-
-        # Iterate over over the tracks and the bars.
-        bar_indices = get_bar_indices(bars, window_size_bars, hop_length_bars)
-        for track_data in song_data["tracks"]:
-            for bar_start_index, bar_end_index in bar_indices:
-
-                # Go through the bars and count notes.
-                count = 0
-                for bar in track_data["bars"][bar_start_index:bar_end_index]:
-                    count += len([event for event in bar["events"] if event["type"] == "NOTE_ON"])
-
-                # Do not count empty tracks.
-                if count != 0:
-                    distribution += [count]
+        bar_indices = get_bar_indices(get_bars_number(song_data), window_size_bars, hop_length_bars)
+        distribution.add(get_window_note_on_counts(get_note_on_counts(song_data), bar_indices))
 
     # Compute the quantiles, which will become the density bins.
-    quantiles = []
-    for i in range(100 // bins, 100, 100 // bins):
-        quantile = np.percentile(distribution, i)
-        quantiles += [quantile]
-    return quantiles
+    return distribution.get_quantiles(bins)
+
+
+class DensityDistribution:
+
+    # The note on counts of all windows of all tracks. Empty tracks do not count. Streaming keeps
+    # a histogram instead of all counts. The counts are integers, so the quantiles are the same.
+    def __init__(self, streaming=False):
+        self.streaming = streaming
+        self.counts = []
+        self.histogram = np.zeros(0, dtype=np.int64)
+
+    def add(self, window_note_on_counts):
+        counts = window_note_on_counts.ravel()
+        counts = counts[counts != 0]
+        if not self.streaming:
+            self.counts += [counts]
+            return
+        histogram = np.bincount(counts)
+        if len(histogram) > len(self.histogram):
+            histogram[:len(self.histogram)] += self.histogram
+            self.histogram = histogram
+        else:
+            self.histogram[:len(histogram)] += histogram
+
+    def get_quantiles(self, bins):
+        percentiles = list(range(100 // bins, 100, 100 // bins))
+        if not self.streaming:
+            return np.percentile(np.concatenate(self.counts), percentiles).tolist()
+
+        # The same linear interpolation between the closest ranks as np.percentile.
+        cumulative_histogram = np.cumsum(self.histogram)
+        positions = np.array(percentiles, dtype=np.float64) / 100 * (cumulative_histogram[-1] - 1)
+        lower_ranks = np.floor(positions).astype(np.int64)
+        upper_ranks = np.minimum(lower_ranks + 1, cumulative_histogram[-1] - 1)
+        lower_counts = np.searchsorted(cumulative_histogram, lower_ranks, side="right")
+        upper_counts = np.searchsorted(cumulative_histogram, upper_ranks, side="right")
+        return (lower_counts + (upper_counts - lower_counts) * (positions - lower_ranks)).tolist()
+
+
+def get_note_on_counts(song_data):
+
+    # The note on events of each bar of each track. Bars that are filled count as empty.
+    note_on_counts = np.zeros((len(song_data["tracks"]), get_bars_number(song_data)), dtype=np.int64)
+    for track_index, track_data in enumerate(song_data["tracks"]):
+        for bar_index, bar_data in enumerate(track_data["bars"]):
+            if bar_data["events"] != "bar_fill":
+                note_on_counts[track_index, bar_index] = bar_data["events"].get_note_on_count()
+    return note_on_counts
+
+
+def get_window_note_on_counts(note_on_counts, bar_indices):
+
+    # The note on events of each track in each window. Differences of the cumulative counts.
+    cumulative_counts = np.concatenate([np.zeros((len(note_on_counts), 1), dtype=np.int64), np.cumsum(note_on_counts, axis=1)], axis=1)
+    bar_start_indices = np.array([bar_start_index for bar_start_index, _ in bar_indices], dtype=np.int64)
+    bar_end_indices = np.array([bar_end_index for _, bar_end_index in bar_indices], dtype=np.int64)
+    return cumulative_counts[:, bar_end_indices] - cumulative_counts[:, bar_start_indices]
+
+
+def get_song_vocabulary(song_data, transpositions, window_size_bars, hop_length_bars):
+
+    # The instrument and event tokens that encoding the song emits. Only the bars in the windows
+    # count. Songs that are too short for a window emit nothing.
+    bar_indices = get_bar_indices(get_bars_number(song_data), window_size_bars, hop_length_bars)
+    window_bar_indices = sorted(set(bar_index for bar_start_index, bar_end_index in bar_indices for bar_index in range(bar_start_index, bar_end_index)))
+    vocabulary = set()
+    if len(bar_indices) == 0:
+        return vocabulary
+    for track_data in song_data["tracks"]:
+        bars_events = [track_data["bars"][bar_index]["events"] for bar_index in window_bar_indices if bar_index < len(track_data["bars"])]
+
+        # Drums are never transposed.
+        if not track_data.get("drums", False):
+            vocabulary.add(f"INST={track_data['number']}")
+            track_transpositions = np.array(transpositions, dtype=np.int64)
+        else:
+            vocabulary.add("INST=DRUMS")
+            track_transpositions = np.zeros(1, dtype=np.int64)
+        if len(bars_events) == 0:
+            continue
+
+        # Render the tokens like encode_bar_events does.
+        types = np.concatenate([bar_events.types for bar_events in bars_events])
+        values = np.concatenate([bar_events.values for bar_events in bars_events])
+        for event_type in np.unique(types).tolist():
+            event_values = np.unique(values[types == event_type])
+            if event_type == EVENT_TIME_DELTA:
+                vocabulary.update(EVENT_TYPES[event_type] + "=" + str(value) for value in event_values.tolist())
+            else:
+                pitches = np.unique(event_values.astype(np.int64)[:, None] + track_transpositions[None, :])
+                vocabulary.update(EVENT_TYPES[event_type] + "=" + str(pitch) for pitch in pitches.tolist())
+    return vocabulary
+
+
+def get_vocabulary(songs_vocabulary, density_bins, bar_fill):
+
+    # The complete vocabulary in a deterministic order. First the structural tokens, then the
+    # instruments, the densities and the events. Each group sorted by value.
+    vocabulary = set(songs_vocabulary)
+    vocabulary.update(STRUCTURE_TOKENS)
+    if bar_fill:
+        vocabulary.update(FILL_TOKENS)
+    vocabulary.update(f"DENSITY={density}" for density in range(len(density_bins) + 1))
+
+    groups = STRUCTURE_TOKENS + FILL_TOKENS + ["INST", "DENSITY"] + EVENT_TYPES
+    def get_sort_key(token):
+        group, _, value = token.partition("=")
+        if group not in groups:
+            return (len(groups), 0, 0.0, token)
+        if value == "":
+            return (groups.index(group), 0, 0.0, token)
+        try:
+            return (groups.index(group), 0, float(value), token)
+        except ValueError:
+            return (groups.index(group), 1, 0.0, token)
+    return sorted(vocabulary, key=get_sort_key)
 
 
 def get_bars_number(song_data):
@@ -14,32 +14,108 @@
 
 # Lint as: python3
 
+import os
+import multiprocessing
 import music21
 from music21 import corpus
 from source import logging
-from source.preprocess.preprocessutilities import events_to_events_data
+from source.preprocess import preprocessutilities
+from source.preprocess.preprocessutilities import (
+    events_to_events_data,
+    get_song_data_cache_key,
+    load_song_data_from_cache,
+    save_song_data_to_cache
+)
 
 logger = logging.create_logger("music21jsb")
 
+preprocess_music21_version = None
 
-def preprocess_music21():
+
+def preprocess_music21(workers=1, chunk_size=1, cache_path=None):
 
     logger.info("Loading songs...")
-    songs = list(corpus.chorales.Iterator())
-    logger.info(f"Got {len(songs)} songs.")
+    numbers = list(corpus.chorales.Iterator().numberList)
+    logger.info(f"Got {len(numbers)} songs.")
+
+    split_index = int(0.8 * len(numbers))
+    numbers_train = numbers[:split_index]
+    numbers_valid = numbers[split_index:]
+    logger.info(f"Using {len(numbers_train)} songs for training.")
+    logger.info(f"Using {len(numbers_valid)} songs for validation.")
 
-    split_index = int(0.8 * len(songs))
-    songs_train = songs[:split_index]
-    songs_valid = songs[split_index:]
-    logger.info(f"Using {len(songs_train)} songs for training.")
-    logger.info(f"Using {len(songs_valid)} songs for validation.")
+    if cache_path is not None:
+        logger.info(f"Using song data cache at {cache_path}.")
 
-    songs_data_train = preprocess_music21_songs(songs_train, train=True)
-    songs_data_valid = preprocess_music21_songs(songs_valid, train=False)
+    songs_data_train = preprocess_music21_chorales(numbers_train, train=True, workers=workers, chunk_size=chunk_size, cache_path=cache_path)
+    songs_data_valid = preprocess_music21_chorales(numbers_valid, train=False, workers=workers, chunk_size=chunk_size, cache_path=cache_path)
 
     return songs_data_train, songs_data_valid
 
 
+def preprocess_music21_chorales(numbers, train, workers=1, chunk_size=1, cache_path=None):
+
+    # Parse and preprocess the chorales. Either in this process or sharded over a pool.
+    # Pool.imap keeps the order of the results, so the output does not depend on workers.
+    tasks = [(number, train, cache_path) for number in numbers]
+    if workers == 1:
+        songs_data = list(map(preprocess_music21_chorale, tasks))
+    else:
+        logger.info(f"Preprocessing with {workers} workers and chunk size {chunk_size}.")
+        with multiprocessing.Pool(workers) as pool:
+            songs_data = list(pool.imap(preprocess_music21_chorale, tasks, chunksize=chunk_size))
+
+    # Remove the songs that have been skipped.
+    songs_data = [song_data for song_data in songs_data if song_data is not None]
+    return songs_data
+
+
+def preprocess_music21_chorale(task):
+
+    number, train, cache_path = task
+
+    # Try the cache first. The key changes when the source file or the preprocessing changes.
+    if cache_path is not None:
+        filename = next(corpus.chorales.Iterator(number, number, returnType="filename"))
+        source_paths = corpus.getWork(filename)
+        if not isinstance(source_paths, list):
+            source_paths = [source_paths]
+        source_paths = [str(source_path) for source_path in source_paths]
+        cache_key = get_song_data_cache_key(
+            *source_paths,
+            *[os.path.getmtime(source_path) for source_path in source_paths],
+            number,
+            train,
+            get_preprocess_music21_version()
+        )
+        found, song_data = load_song_data_from_cache(cache_path, cache_key)
+        if found:
+            return song_data
+
+    # Parse the chorale with its riemenschneider number. The iterator sets title and number.
+    song = next(corpus.chorales.Iterator(number, number))
+    song_data = preprocess_music21_song(song, train)
+
+    # Store for the next run.
+    if cache_path is not None:
+        save_song_data_to_cache(cache_path, cache_key, song_data)
+
+    return song_data
+
+
+def get_preprocess_music21_version():
+
+    # Hash the preprocessing code and the music21 version. Any change invalidates the cache.
+    global preprocess_music21_version
+    if preprocess_music21_version is None:
+        sources = [music21.__version__]
+        for module_path in [__file__, preprocessutilities.__file__]:
+            with open(module_path, "r") as file:
+                sources += [file.read()]
+        preprocess_music21_version = get_song_data_cache_key(*sources)
+    return preprocess_music21_version
+
+
 def preprocess_music21_songs(songs, train):
     #print("SONGS")
 
@@ -84,16 +160,35 @@ def preprocess_music21_part(part, part_index, train):
     track_data["number"] = part_index
     track_data["bars"] = []
 
-    for measure_index in range(1000):
-        measure = part.measure(measure_index)
-        if measure is None:
-            break
-
+    for measure in get_music21_part_measures(part):
         bar_data = preprocess_music21_measure(measure, train)
         track_data["bars"] += [bar_data]
     return track_data
 
 
+def get_music21_part_measures(part, measures_maximum=1000):
+
+    # Index the measures by number in one pass. This mirrors part.measure(number), which
+    # returns the first measure with that number, so repeated numbers like 7a are skipped.
+    measures = list(part.getElementsByClass("Measure"))
+
+    # Without any measure numbers part.measure(0) would never match.
+    if all(measure.number == 0 for measure in measures):
+        return []
+
+    measures_by_number = {}
+    for measure in measures:
+        measures_by_number.setdefault(measure.number, measure)
+
+    # Start at the pickup measure 0 and stop at the first gap.
+    result = []
+    for measure_number in range(measures_maximum):
+        if measure_number not in measures_by_number:
+            break
+        result += [measures_by_number[measure_number]]
+    return result
+
+
 def preprocess_music21_measure(measure, train):
     #print("      MEASURE")
 
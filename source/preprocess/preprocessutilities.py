@@ -14,6 +14,16 @@
 
 # Lint as: python3
 
+import os
+import json
+import hashlib
+import numpy as np
+
+EVENT_NOTE_ON = 0
+EVENT_NOTE_OFF = 1
+EVENT_TIME_DELTA = 2
+EVENT_TYPES = ["NOTE_ON", "NOTE_OFF", "TIME_DELTA"]
+
 
 def events_to_events_data(events):
 
@@ -47,3 +57,120 @@ def events_to_events_data(events):
             events_data += [event_data]
 
     return events_data
+
+
+# The events of a bar as parallel arrays. Types are EVENT_* codes, values are pitches or deltas.
+class BarEvents:
+
+    __slots__ = ("types", "values", "note_on_count")
+
+    def __init__(self, types, values):
+        self.types = np.asarray(types, dtype=np.int8)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.note_on_count = None
+
+    def __len__(self):
+        return len(self.types)
+
+    def get_note_on_count(self):
+
+        # Counted once. Density bins and encoding both need it.
+        if self.note_on_count is None:
+            self.note_on_count = int(np.count_nonzero(self.types == EVENT_NOTE_ON))
+        return self.note_on_count
+
+    @staticmethod
+    def from_events_data(events_data):
+        types = []
+        values = []
+        for event_data in events_data:
+            event_type = EVENT_TYPES.index(event_data["type"])
+            types += [event_type]
+            if event_type == EVENT_TIME_DELTA:
+                values += [event_data["delta"]]
+            else:
+                values += [event_data["pitch"]]
+        return BarEvents(types, values)
+
+    def to_events_data(self):
+        events_data = []
+        for event_type, value in zip(self.types.tolist(), self.values.tolist()):
+            if event_type == EVENT_TIME_DELTA:
+                events_data += [{"type": EVENT_TYPES[event_type], "delta": value}]
+            else:
+                events_data += [{"type": EVENT_TYPES[event_type], "pitch": int(value)}]
+        return events_data
+
+
+def song_data_to_compact(song_data):
+
+    # Converts the events of all bars to BarEvents. Bars that are already compact are kept.
+    song_data = dict(song_data)
+    song_data["tracks"] = [dict(track_data) for track_data in song_data["tracks"]]
+    for track_data in song_data["tracks"]:
+        bars_data = []
+        for bar_data in track_data["bars"]:
+            bar_data = dict(bar_data)
+            if isinstance(bar_data["events"], list):
+                bar_data["events"] = BarEvents.from_events_data(bar_data["events"])
+            bars_data += [bar_data]
+        track_data["bars"] = bars_data
+    return song_data
+
+
+def song_data_from_compact(song_data):
+
+    # The inverse of song_data_to_compact. Yields the JSON compatible format.
+    song_data = dict(song_data)
+    song_data["tracks"] = [dict(track_data) for track_data in song_data["tracks"]]
+    for track_data in song_data["tracks"]:
+        bars_data = []
+        for bar_data in track_data["bars"]:
+            bar_data = dict(bar_data)
+            if isinstance(bar_data["events"], BarEvents):
+                bar_data["events"] = bar_data["events"].to_events_data()
+            bars_data += [bar_data]
+        track_data["bars"] = bars_data
+    return song_data
+
+
+def get_song_data_cache_key(*parts):
+    hash = hashlib.sha1()
+    for part in parts:
+        hash.update(str(part).encode("utf-8"))
+        hash.update(b"\0")
+    return hash.hexdigest()
+
+
+def get_song_data_hash(song_data):
+
+    # The hash of the content of a song. Compact or not, the same song gives the same hash.
+    song_data_json = json.dumps(song_data_from_compact(song_data), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(song_data_json.encode("utf-8")).hexdigest()
+
+
+def get_song_data_cache_file(cache_path, cache_key):
+    return os.path.join(cache_path, f"{cache_key}.json")
+
+
+def load_song_data_from_cache(cache_path, cache_key):
+
+    # Nothing cached yet. Note that skipped songs are cached as null.
+    cache_file = get_song_data_cache_file(cache_path, cache_key)
+    if not os.path.exists(cache_file):
+        return False, None
+
+    with open(cache_file, "r") as file:
+        return True, json.load(file)
+
+
+def save_song_data_to_cache(cache_path, cache_key, song_data):
+
+    # Write to a temporary file first. That way an interrupted run never leaves half a file.
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path, exist_ok=True)
+    cache_file = get_song_data_cache_file(cache_path, cache_key)
+    cache_file_temporary = f"{cache_file}.{os.getpid()}.tmp"
+    with open(cache_file_temporary, "w") as file:
+        json.dump(song_data, file)
+    os.replace(cache_file_temporary, cache_file)
@@ -0,0 +1,265 @@
+# Copyright 2021 Tristan Behrens.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+
+# Sampling server. Loads the model and the tokenizer once and answers generation requests over HTTP.
+# Concurrent requests are combined into batches.
+#
+# The model path can also point to a model exported with python -m source.export.
+#
+# python -m source.serve --model_path training/jsb_mmmtrack/best_model --tokenizer_path datasets/jsb_mmmtrack/tokenizer.json
+#
+# POST /generate with a JSON body like {"token_sequences": ["PIECE_START TRACK_START ..."]}.
+# Optional fields are num_return_sequences, max_new_tokens, temperature, top_k, top_p,
+# stop_tokens, stop_tokens_count, use_grammar and midi. Invalid requests are answered with 400.
+
+import argparse
+import base64
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from transformers import PreTrainedTokenizerFast
+from source import logging
+from source.helpers.exporthelpers import load_model
+from source.helpers.grammarhelpers import MMMGrammar
+from source.helpers.midihelpers import note_table_to_midi_bytes
+from source.helpers.notetablehelpers import token_sequences_to_note_tables
+from source.helpers.samplinghelpers import generate_batch
+
+logger = logging.create_logger("serve")
+
+GENERATE_OPTIONS_DEFAULTS = {
+    "num_return_sequences": 1,
+    "max_new_tokens": 256,
+    "temperature": 0.9,
+    "top_k": None,
+    "top_p": None,
+    "stop_tokens": ["PIECE_END", "TRACK_END"],
+    "stop_tokens_count": 1,
+    "use_grammar": False
+}
+
+# Upper bounds of the request. They keep a single request from blocking the server.
+MAX_TOKEN_SEQUENCES = 64
+MAX_NUM_RETURN_SEQUENCES = 16
+MAX_NEW_TOKENS = 2048
+
+
+class DynamicBatcher:
+
+    # Collects requests until the batch is full or the first request has waited long enough.
+    # Requests with different generation options end up in different batches.
+    def __init__(self, model, tokenizer, max_batch_size=32, max_wait_time=0.01):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def submit(self, token_sequence, options):
+        future = Future()
+        self.queue.put((token_sequence, options, future))
+        return future
+
+    def __run(self):
+        while True:
+
+            # Wait for the first request. Then collect more until the deadline.
+            requests = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait_time
+            while len(requests) < self.max_batch_size:
+                remaining_time = deadline - time.perf_counter()
+                if remaining_time <= 0:
+                    break
+                try:
+                    requests += [self.queue.get(timeout=remaining_time)]
+                except queue.Empty:
+                    break
+
+            # Group by options and generate.
+            groups = {}
+            for request in requests:
+                key = json.dumps(request[1], sort_keys=True)
+                groups.setdefault(key, []).append(request)
+            for group in groups.values():
+                self.__generate(group)
+
+    def __generate(self, requests):
+        options = requests[0][1]
+        try:
+            generated_sequences = generate_batch(
+                self.model,
+                self.tokenizer,
+                [token_sequence for token_sequence, _, _ in requests],
+                batch_size=self.max_batch_size,
+                **options
+            )
+        except Exception as exception:
+
+            # Retry one by one. That way a single bad request does not fail the others.
+            if len(requests) > 1:
+                for request in requests:
+                    self.__generate([request])
+                return
+            requests[0][2].set_exception(exception)
+            return
+        logger.debug(f"Generated a batch of {len(requests)} requests.")
+        for (_, _, future), sequences in zip(requests, generated_sequences):
+            future.set_result(sequences)
+
+
+def token_sequence_to_midi_base64(token_sequence):
+
+    # None if the token sequence cannot be decoded.
+    note_table = token_sequences_to_note_tables([token_sequence], use_program=False, skip_invalid=True)[0]
+    if note_table is None:
+        return None
+    return base64.b64encode(note_table_to_midi_bytes(note_table)).decode("ascii")
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def parse_generate_request(request, tokenizer=None, grammar=None):
+
+    # Checks the types and the bounds of the request. Raises an exception with the reason.
+    # With a grammar, the token sequences must be valid for use_grammar.
+    if not isinstance(request, dict):
+        raise Exception("The body must be a JSON object.")
+    token_sequences = request.get("token_sequences")
+    if not isinstance(token_sequences, list) or not 0 < len(token_sequences) <= MAX_TOKEN_SEQUENCES:
+        raise Exception(f"token_sequences must be a list of 1 to {MAX_TOKEN_SEQUENCES} strings.")
+    if not all(isinstance(token_sequence, str) for token_sequence in token_sequences):
+        raise Exception("token_sequences must only contain strings.")
+
+    options = {key: request.get(key, value) for key, value in GENERATE_OPTIONS_DEFAULTS.items()}
+    if not is_integer(options["num_return_sequences"]) or not 1 <= options["num_return_sequences"] <= MAX_NUM_RETURN_SEQUENCES:
+        raise Exception(f"num_return_sequences must be an integer from 1 to {MAX_NUM_RETURN_SEQUENCES}.")
+    if not is_integer(options["max_new_tokens"]) or not 1 <= options["max_new_tokens"] <= MAX_NEW_TOKENS:
+        raise Exception(f"max_new_tokens must be an integer from 1 to {MAX_NEW_TOKENS}.")
+    if not is_number(options["temperature"]) or not options["temperature"] > 0:
+        raise Exception("temperature must be a positive number.")
+    if options["top_k"] is not None and (not is_integer(options["top_k"]) or options["top_k"] < 1):
+        raise Exception("top_k must be a positive integer or null.")
+    if options["top_p"] is not None and (not is_number(options["top_p"]) or not 0 < options["top_p"] <= 1):
+        raise Exception("top_p must be a number in (0, 1] or null.")
+    if not isinstance(options["stop_tokens"], list) or not all(isinstance(token, str) for token in options["stop_tokens"]):
+        raise Exception("stop_tokens must be a list of strings.")
+    if not is_integer(options["stop_tokens_count"]) or options["stop_tokens_count"] < 1:
+        raise Exception("stop_tokens_count must be a positive integer.")
+    if not isinstance(options["use_grammar"], bool):
+        raise Exception("use_grammar must be a boolean.")
+
+    if options["use_grammar"] and grammar is not None:
+        for index, token_sequence in enumerate(token_sequences):
+            if not grammar.is_valid(tokenizer(token_sequence).input_ids):
+                raise Exception(f"Token sequence {index} breaks the grammar.")
+
+    midi = request.get("midi", False)
+    if not isinstance(midi, bool):
+        raise Exception("midi must be a boolean.")
+    return token_sequences, options, midi
+
+
+def create_request_handler(batcher):
+    grammar = MMMGrammar(batcher.tokenizer.get_vocab())
+
+    class RequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.__send(200, {"status": "ok"})
+            else:
+                self.__send(404, {"error": f"Unknown path {self.path}."})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self.__send(404, {"error": f"Unknown path {self.path}."})
+                return
+
+            # Parse the request.
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                token_sequences, options, midi = parse_generate_request(request, batcher.tokenizer, grammar)
+            except Exception as exception:
+                self.__send(400, {"error": f"Invalid request: {exception}"})
+                return
+
+            # Every priming sequence is a request of its own. That way they can be batched.
+            try:
+                futures = [batcher.submit(token_sequence, options) for token_sequence in token_sequences]
+                generated_sequences = [future.result() for future in futures]
+            except Exception as exception:
+                logger.error(f"Generation failed: {exception}")
+                self.__send(500, {"error": str(exception)})
+                return
+
+            response = {"token_sequences": generated_sequences}
+            if midi:
+                response["midi"] = [[token_sequence_to_midi_base64(sequence) for sequence in sequences] for sequences in generated_sequences]
+            self.__send(200, response)
+
+        def __send(self, status, body):
+            body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return RequestHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MMM sampling server.")
+    parser.add_argument("--model_path", required=True)
+    parser.add_argument("--tokenizer_path", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_time", type=float, default=0.01, help="In seconds.")
+    args = parser.parse_args()
+
+    # Load everything once.
+    tokenizer = PreTrainedTokenizerFast(tokenizer_file=args.tokenizer_path)
+    tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+    model = load_model(args.model_path)
+    logger.info(f"Loaded model from {args.model_path}.")
+
+    batcher = DynamicBatcher(model, tokenizer, max_batch_size=args.max_batch_size, max_wait_time=args.max_wait_time)
+    server = ThreadingHTTPServer((args.host, args.port), create_request_handler(batcher))
+    logger.info(f"Serving on http://{args.host}:{args.port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()